@@ -1,25 +1,66 @@
 
-import weakref, sys
+import weakref, sys, threading, time, re
 import rstrategies_logger
 from rpython.rlib import jit, objectmodel, rerased
 from rpython.rlib.objectmodel import specialize
+from rpython.rlib.rarithmetic import LONG_BIT
 
-def make_accessors(strategy='strategy', storage='storage'):
+WORD = LONG_BIT // 8
+
+# Loops over the elements of collections are only unrolled by the JIT, if the
+# number of iterations is a small constant (or the list is virtual).
+# Otherwise, the loop is executed in a residual call, keeping traces small.
+UNROLL_CUTOFF = 8
+
+def unroll_elements(self, w_self, index0, list_w):
+    return jit.loop_unrolling_heuristic(list_w, len(list_w), UNROLL_CUTOFF)
+
+def unroll_conversion(self, w_self, previous_strategy):
+    size = previous_strategy.size(w_self)
+    return jit.isconstant(size) and size <= UNROLL_CUTOFF
+
+def unroll_objects(self, objects):
+    return jit.loop_unrolling_heuristic(objects, len(objects), UNROLL_CUTOFF)
+
+def make_accessors(strategy='strategy', storage='storage', version=None):
     """
     Instead of using this generator, the methods can be implemented manually.
     Alternatively, the getter/setter methods in StrategyFactory can be overwritten.
+    The version attribute is only required for factories with atomic_switches enabled.
     """
-    def make_getter(attr):
-        def getter(self): return getattr(self, attr)
-        return getter
-    def make_setter(attr):
-        def setter(self, val): setattr(self, attr, val)
-        return setter
     classdef = sys._getframe(1).f_locals
-    classdef['_get_strategy'] = make_getter(strategy)
-    classdef['_set_strategy'] = make_setter(strategy)
-    classdef['_get_storage'] = make_getter(storage)
-    classdef['_set_storage'] = make_setter(storage)
+    classdef['_get_strategy'], classdef['_set_strategy'] = make_attribute_accessors(strategy)
+    classdef['_get_storage'], classdef['_set_storage'] = make_attribute_accessors(storage)
+    if version is not None:
+        classdef['_get_version'], classdef['_set_version'] = make_attribute_accessors(version)
+
+def make_attribute_accessors(attr):
+    "NOT_RPYTHON"
+    # The attribute name is compiled into the accessors, instead of calling getattr/setattr.
+    assert re.match("^[a-zA-Z_][a-zA-Z0-9_]*$", attr), "Invalid attribute name: %s" % attr
+    source = "def getter(self): return self.%s\ndef setter(self, val): self.%s = val\n" % (attr, attr)
+    namespace = {}
+    exec source in namespace
+    return namespace['getter'], namespace['setter']
+
+# Maps every class created by StrategyMetaclass to its erase/unerase functions.
+erasing_pairs = {}
+
+def make_storage_accessors(erase, unerase, through_factory):
+    "NOT_RPYTHON"
+    if through_factory:
+        def get_storage(self, w_self):
+            erased = self.strategy_factory().get_storage(w_self)
+            return unerase(erased)
+        def set_storage(self, w_self, storage):
+            erased = erase(storage)
+            self.strategy_factory().set_storage(w_self, erased)
+    else:
+        def get_storage(self, w_self):
+            return unerase(w_self._get_storage())
+        def set_storage(self, w_self, storage):
+            w_self._set_storage(erase(storage))
+    return get_storage, set_storage
 
 class StrategyMetaclass(type):
     """
@@ -31,15 +72,12 @@ class StrategyMetaclass(type):
         attrs['_specializations'] = []
         # Not every strategy uses rerased-pairs, but they won't hurt
         erase, unerase = rerased.new_erasing_pair(name)
-        def get_storage(self, w_self):
-            erased = self.strategy_factory().get_storage(w_self)
-            return unerase(erased)
-        def set_storage(self, w_self, storage):
-            erased = erase(storage)
-            self.strategy_factory().set_storage(w_self, erased)
-        attrs['get_storage'] = get_storage
-        attrs['set_storage'] = set_storage
-        return type.__new__(self, name, bases, attrs)
+        # Access the storage directly. If the factory overwrites its storage accessors,
+        # these methods are replaced when the factory is created (see route_storage_access).
+        attrs['get_storage'], attrs['set_storage'] = make_storage_accessors(erase, unerase, False)
+        cls = type.__new__(self, name, bases, attrs)
+        erasing_pairs[cls] = (erase, unerase)
+        return cls
     
 def strategy(generalize=None, singleton=True):
     """
@@ -49,16 +87,8 @@ def strategy(generalize=None, singleton=True):
     instead of always reusing the singleton object.
     """
     def decorator(strategy_class):
-        # Patch strategy class: Add generalized_strategy_for and mark as strategy class.
+        # Mark as strategy class. The generalizations are evaluated by the StrategyFactory.
         if generalize:
-            @jit.unroll_safe
-            def generalized_strategy_for(self, value):
-                # TODO - optimize this method
-                for strategy in generalize:
-                    if self.strategy_factory().strategy_singleton_instance(strategy).check_can_handle(value):
-                        return strategy
-                raise Exception("Could not find generalized strategy for %s coming from %s" % (value, self))
-            strategy_class.generalized_strategy_for = generalized_strategy_for
             for generalized in generalize:
                 generalized._specializations.append(strategy_class)
         strategy_class._is_strategy = True
@@ -67,26 +97,52 @@ def strategy(generalize=None, singleton=True):
         return strategy_class
     return decorator
 
+def convert_storage_default(new_strategy, w_self, previous_strategy):
+    new_strategy.convert_storage_from(w_self, previous_strategy)
+
 class StrategyFactory(object):
-    _immutable_fields_ = ["strategies[*]", "logger", "strategy_singleton_field"]
+    _immutable_fields_ = ["strategies[*]", "logger", "strategy_singleton_field", "atomic_switches",
+                          "strategy_id_field", "strategy_names[*]", "conversions[*]", "generalizations[*]",
+                          "generalization_starts[*]",
+                          "unboxed_key_strategies[*]"]
     factory_instance_counter = 0
     
-    def __init__(self, root_class, all_strategy_classes=None):
+    # Estimated bytes per element in a collection without strategies: a pointer plus a boxed object.
+    # Strategies report their own costs in slot_bytes(). Overwrite this for the boxes of your VM.
+    generic_slot_bytes = 3 * WORD
+    
+    def __init__(self, root_class, all_strategy_classes=None, atomic_switches=False):
+        """
+        If atomic_switches is set, every collection has a version counter, which is incremented
+        before and after every (outermost) strategy switch. Together with read_consistent(), this allows
+        lock-free readers on other threads when running untranslated. Switches are serialized
+        by a lock, all other modifications of collections must still be synchronized by the VM.
+        """
+        self.atomic_switches = atomic_switches
+        self.switch_lock = threading.RLock() if atomic_switches else None
         if all_strategy_classes is None:
             all_strategy_classes = self.collect_subclasses(root_class)
+        else:
+            all_strategy_classes = self.unique_classes(all_strategy_classes)
         self.strategies = []
         self.logger = rstrategies_logger.Logger()
         
         # This is to avoid confusion between multiple factories existing simultaneously (e.g. in tests)
         self.strategy_singleton_field = "__singleton_%i" % StrategyFactory.factory_instance_counter
+        self.strategy_id_field = "__strategy_id_%i" % StrategyFactory.factory_instance_counter
         StrategyFactory.factory_instance_counter += 1
         
         for strategy_class in all_strategy_classes:
             if strategy_class._is_strategy:
                 setattr(strategy_class, self.strategy_singleton_field, self.instantiate_strategy(strategy_class))
                 self.strategies.append(strategy_class)
-            self.patch_strategy_class(strategy_class, root_class)
         self.order_strategies()
+        self.init_strategy_tables(all_strategy_classes)
+        self.logger.prepare_counters(self.strategy_names)
+        self.logger.set_slot_bytes(self.collect_slot_bytes(), self.generic_slot_bytes)
+        if self.overrides_storage_access():
+            for strategy_class in all_strategy_classes:
+                self.route_storage_access(strategy_class)
     
     # =============================
     # API methods
@@ -97,6 +153,49 @@ class StrategyFactory(object):
         Switch the strategy of w_self to the new type.
         new_element can be given as as hint, purely for logging purposes.
         """
+        if self.atomic_switches:
+            return self.switch_strategy_atomic(w_self, new_strategy_type, new_element)
+        return self.do_switch_strategy(w_self, new_strategy_type, new_element)
+    
+    def read_consistent(self, w_self, read):
+        """
+        NOT_RPYTHON
+        Return read(strategy), where strategy is the current strategy of w_self.
+        Requires atomic_switches. No lock is acquired: if the strategy of w_self is switched
+        concurrently, read is called again. Therefore, read should not have side effects.
+        """
+        while True:
+            version = self.get_version(w_self)
+            if version & 1:
+                # Switch in progress.
+                time.sleep(0)
+                continue
+            strategy = self.get_strategy(w_self)
+            try:
+                result = read(strategy)
+            except Exception:
+                if self.get_version(w_self) != version:
+                    continue
+                raise
+            if self.get_version(w_self) == version:
+                return result
+    
+    def switch_strategy_atomic(self, w_self, new_strategy_type, new_element):
+        "NOT_RPYTHON"
+        with self.switch_lock:
+            # Switches can be nested, e.g. by a strategy_switched hook switching w_self again.
+            # The lock is reentrant, so an odd version means that this thread is already switching
+            # w_self, and only that outermost switch increments the version.
+            outermost = self.get_version(w_self) & 1 == 0
+            if outermost:
+                self.set_version(w_self, self.get_version(w_self) + 1)
+            try:
+                return self.do_switch_strategy(w_self, new_strategy_type, new_element)
+            finally:
+                if outermost:
+                    self.set_version(w_self, self.get_version(w_self) + 1)
+    
+    def do_switch_strategy(self, w_self, new_strategy_type, new_element):
         old_strategy = self.get_strategy(w_self)
         if new_strategy_type._is_singleton:
             new_strategy = self.strategy_singleton_instance(new_strategy_type)
@@ -104,12 +203,19 @@ class StrategyFactory(object):
             size = old_strategy.size(w_self)
             new_strategy = self.instantiate_strategy(new_strategy_type, w_self, size)
         self.set_strategy(w_self, new_strategy)
-        old_strategy.convert_storage_to(w_self, new_strategy)
-        new_strategy.strategy_switched(w_self)
+        if self.logger.timing:
+            start = self.logger.timer()
+            old_strategy.convert_storage_to(w_self, new_strategy)
+            new_strategy.strategy_switched(w_self)
+            duration = self.logger.timer() - start
+            self.logger.time_switch(self.strategy_id(old_strategy), self.strategy_id(new_strategy), duration)
+        else:
+            old_strategy.convert_storage_to(w_self, new_strategy)
+            new_strategy.strategy_switched(w_self)
         self.log(w_self, new_strategy, old_strategy, new_element)
         return new_strategy
     
-    def set_initial_strategy(self, w_self, strategy_type, size, elements=None):
+    def set_initial_strategy(self, w_self, strategy_type, size, elements=None, log=True):
         """
         Initialize the strategy and storage fields of w_self.
         This must be called before switch_strategy or any strategy method can be used.
@@ -121,6 +227,8 @@ class StrategyFactory(object):
             strategy = self.strategy_singleton_instance(strategy_type)
         else:
             strategy = self.instantiate_strategy(strategy_type, w_self, size)
+        if self.atomic_switches:
+            self.set_version(w_self, 0)
         self.set_strategy(w_self, strategy)
         strategy.initialize_storage(w_self, size)
         element = None
@@ -128,10 +236,88 @@ class StrategyFactory(object):
             strategy.store_all(w_self, elements)
             if len(elements) > 0: element = elements[0]
         strategy.strategy_switched(w_self)
-        self.log(w_self, strategy, None, element)
+        if log:
+            self.log(w_self, strategy, None, element)
         return strategy
     
-    @jit.unroll_safe
+    def set_initial_strategy_unwrapped(self, w_self, strategy_type, unwrapped_storage, copy=False, log=True):
+        """
+        Initialize the strategy and storage fields of w_self directly from a buffer of unwrapped values,
+        e.g. when loading an image or deserializing data. The buffer must contain values as they
+        are stored by strategy_type (see _unwrap), so no value is wrapped or checked individually.
+        Instead, strategy_type gets a chance to reject the entire buffer in check_can_handle_storage.
+        In that case, the values are wrapped (see wrap_storage) and the best fitting strategy is chosen.
+        By default, the buffer is adopted as storage of w_self. Use copy=True if the caller
+        keeps using the buffer. Buffers that strategy_type can not adopt (see can_adopt_storage),
+        like a bytearray or array.array for a strategy storing lists, are always copied.
+        The copy is made by copy_storage of strategy_type; immutable buffers (like the host
+        strings of StringStrategy) are not copied.
+        Use log=False and log_created_batch() to log many collections as a single event.
+        """
+        assert self.get_strategy(w_self) is None, "Strategy should not be initialized yet!"
+        prototype = self.strategy_singleton_instance(strategy_type)
+        if not prototype.check_can_handle_storage(unwrapped_storage):
+            elements = prototype.wrap_storage(unwrapped_storage)
+            return self.set_initial_strategy(w_self, self.strategy_type_for(elements), len(elements), elements, log)
+        size = prototype.size_of_storage(unwrapped_storage)
+        if copy or not prototype.can_adopt_storage(unwrapped_storage):
+            unwrapped_storage = prototype.copy_storage(unwrapped_storage)
+        if strategy_type._is_singleton:
+            strategy = prototype
+        else:
+            strategy = self.instantiate_strategy(strategy_type, w_self, size)
+        if self.atomic_switches:
+            self.set_version(w_self, 0)
+        self.set_strategy(w_self, strategy)
+        strategy.initialize_storage_unwrapped(w_self, unwrapped_storage)
+        strategy.strategy_switched(w_self)
+        if log:
+            self.log(w_self, strategy, None, None)
+        return strategy
+    
+    def export_raw(self, w_self):
+        """
+        Return a tuple (strategy_type, size, raw_storage) representing the contents of w_self,
+        for example to write them to a snapshot. raw_storage is the result of export_raw of the
+        current strategy of w_self. It is usually not a copy and must not be modified.
+        """
+        strategy = self.get_strategy(w_self)
+        return strategy.__class__, strategy.size(w_self), strategy.export_raw(w_self)
+    
+    def import_raw(self, w_self, strategy_type, size, raw_storage, log=True):
+        """
+        Inverse of export_raw: initialize the strategy and storage fields of w_self
+        from a raw_storage previously exported from a collection with the given strategy_type and size.
+        raw_storage is adopted, not copied.
+        """
+        assert self.get_strategy(w_self) is None, "Strategy should not be initialized yet!"
+        if strategy_type._is_singleton:
+            strategy = self.strategy_singleton_instance(strategy_type)
+        else:
+            strategy = self.instantiate_strategy(strategy_type, w_self, size)
+        if self.atomic_switches:
+            self.set_version(w_self, 0)
+        self.set_strategy(w_self, strategy)
+        strategy.import_raw(w_self, raw_storage)
+        strategy.strategy_switched(w_self)
+        if log:
+            self.log(w_self, strategy, None, None)
+        return strategy
+    
+    def log_created_batch(self, strategy_type, objects, slots):
+        """
+        Log the creation of multiple collections with the given strategy_type as one event.
+        slots is the sum of the sizes of all created collections.
+        Batches are not subject to sampling.
+        """
+        new_strategy = self.strategy_singleton_instance(strategy_type)
+        if self.logger.counting:
+            self.logger.count(-1, self.strategy_id(new_strategy), slots, objects)
+        if not self.logger.active: return
+        new_strategy_str = self.log_string_for_strategy(new_strategy)
+        self.logger.log(new_strategy_str, slots, "Created", objects=objects)
+    
+    @jit.look_inside_iff(unroll_objects)
     def strategy_type_for(self, objects):
         """
         Return the best-fitting strategy to hold all given objects.
@@ -150,6 +336,49 @@ class StrategyFactory(object):
                 return strategy_type
         raise Exception("Could not find strategy to handle: %s" % objects)
     
+    def convert_storage(self, w_self, previous_strategy, new_strategy):
+        """
+        Convert the storage of w_self, which is still in the format of previous_strategy,
+        for new_strategy. The conversion routine is looked up in a table
+        built by init_strategy_tables.
+        """
+        index = self.strategy_id(previous_strategy) * len(self.strategy_names) + self.strategy_id(new_strategy)
+        convert = self.conversions[index]
+        convert(new_strategy, w_self, previous_strategy)
+    
+    @jit.unroll_safe
+    def generalized_strategy_for(self, strategy, value):
+        """
+        Return the first strategy type in the 'generalize' list of strategy, that can handle value.
+        """
+        strategy_id = self.strategy_id(strategy)
+        for i in range(self.generalization_starts[strategy_id], self.generalization_starts[strategy_id + 1]):
+            strategy_type = self.strategies[self.generalizations[i]]
+            if self.strategy_singleton_instance(strategy_type).check_can_handle(value):
+                return strategy_type
+        raise Exception("Could not find generalized strategy for %s coming from %s" % (value, strategy))
+    
+    @jit.unroll_safe
+    def generalized_strategy_for_entry(self, strategy, key, value):
+        """
+        Like generalized_strategy_for, but for map strategies: return the first strategy type
+        in the 'generalize' list of strategy, that can handle the key/value pair.
+        """
+        strategy_id = self.strategy_id(strategy)
+        for i in range(self.generalization_starts[strategy_id], self.generalization_starts[strategy_id + 1]):
+            strategy_type = self.strategies[self.generalizations[i]]
+            if self.strategy_singleton_instance(strategy_type).check_can_handle_entry(key, value):
+                return strategy_type
+        raise Exception("Could not find generalized strategy for %s: %s coming from %s" % (key, value, strategy))
+    
+    @jit.elidable
+    def strategy_id(self, strategy):
+        """
+        Return the compact integer id of the class of the given strategy instance.
+        Ids of strategy classes are indices into self.strategies.
+        """
+        return getattr(strategy, self.strategy_id_field)
+    
     def decorate_strategies(self, transitions):
         """
         As an alternative to decorating all strategies with @strategy,
@@ -177,21 +406,55 @@ class StrategyFactory(object):
         """
         This can be overwritten into a more appropriate call to self.logger.log
         """
+        if self.logger.counting:
+            self.count(w_self, new_strategy, old_strategy)
         if not self.logger.active: return
-        new_strategy_str = self.log_string_for_object(new_strategy)
-        old_strategy_str = self.log_string_for_object(old_strategy)
-        element_typename = self.log_string_for_object(new_element)
         size = new_strategy.size(w_self)
-        typename = ""
+        collection_hash = objectmodel.compute_identity_hash(w_self) if self.logger.sample_collections else 0
+        weight = self.logger.sample_weight(size, collection_hash)
+        if weight == 0: return
+        new_strategy_str = self.log_string_for_strategy(new_strategy)
+        old_strategy_str = self.log_string_for_strategy(old_strategy)
+        element_typename = self.log_string_for_object(new_element)
+        typename = self.log_collection_class(w_self)
+        site = self.log_allocation_site(w_self)
         cause = "Switched" if old_strategy else "Created"
-        self.logger.log(new_strategy_str, size, cause, old_strategy_str, typename, element_typename)
+        self.logger.log(new_strategy_str, size * weight, cause, old_strategy_str, typename, element_typename, weight, site)
+    
+    def count(self, w_self, new_strategy, old_strategy=None):
+        old_strategy_id = self.strategy_id(old_strategy) if old_strategy else -1
+        self.logger.count(old_strategy_id, self.strategy_id(new_strategy), new_strategy.size(w_self))
+    
+    def profile_access(self, w_self, strategy, operation, elements):
+        typename = self.log_collection_class(w_self) if self.logger.profile_classes else ""
+        self.logger.profile(self.strategy_id(strategy), operation, elements, typename)
+    
+    def log_collection_class(self, w_self):
+        """
+        Return the name of the class of w_self for the log. The log parser can break down
+        transitions by this name (-c flag).
+        """
+        return self.log_string_for_object(w_self)
+    
+    def log_allocation_site(self, w_self):
+        """
+        Return a description of the place where w_self was allocated, or "" if unknown.
+        Overwrite this if the VM tracks allocation sites, e.g. by storing the position in the
+        executed program in the collection.
+        """
+        return ""
     
     @objectmodel.specialize.call_location()
     def log_string_for_object(self, obj):
         return obj.__class__.__name__ if obj else ""
     
+    def log_string_for_strategy(self, strategy):
+        return self.strategy_names[self.strategy_id(strategy)] if strategy else ""
+    
     # These storage accessors are specialized because the storage field is 
     # populated by erased-objects which seem to be incompatible sometimes.
+    # By default, strategies access the storage without going through these methods.
+    # If a subclass overwrites them, strategies use them instead (see route_storage_access).
     @specialize.call_location()
     def get_storage(self, obj):
         return obj._get_storage()
@@ -204,49 +467,138 @@ class StrategyFactory(object):
     def set_strategy(self, obj, val):
         return obj._set_strategy(val)
     
+    def get_version(self, obj):
+        return obj._get_version()
+    def set_version(self, obj, val):
+        return obj._set_version(val)
+    
     # =============================
     # Internal methods
     # =============================
     
-    def patch_strategy_class(self, strategy_class, root_class):
+    def init_strategy_tables(self, all_strategy_classes):
         "NOT_RPYTHON"
-        # Patch root class: Add default handler for visitor
-        def convert_storage_from_OTHER(self, w_self, previous_strategy):
-            self.convert_storage_from(w_self, previous_strategy)
-        funcname = "convert_storage_from_" + strategy_class.__name__
-        convert_storage_from_OTHER.func_name = funcname
-        setattr(root_class, funcname, convert_storage_from_OTHER)
+        # Assign compact ids. Strategies come first, so their ids are indices into self.strategies.
+        classes = self.strategies + [ cls for cls in all_strategy_classes if not cls._is_strategy ]
+        self.strategy_names = []
+        for strategy_id, strategy_class in enumerate(classes):
+            setattr(strategy_class, self.strategy_id_field, strategy_id)
+            self.strategy_names.append(strategy_class.__name__)
+        
+        # Conversion table, indexed by (previous strategy id, new strategy id).
+        # Strategies can optimize conversions from other strategies by implementing
+        # methods like convert_storage_from_<OtherStrategyClassName>(self, w_self, previous_strategy).
+        self.conversions = []
+        for previous_class in classes:
+            funcname = "convert_storage_from_" + previous_class.__name__
+            for new_class in classes:
+                convert = getattr(new_class, funcname, None)
+                if convert is None:
+                    self.conversions.append(convert_storage_default)
+                else:
+                    self.conversions.append(convert.im_func)
+        
+        # Generalization table: ids of the strategies in the 'generalize' list of every class.
+        # The ids of all classes are stored in one flat list, so the JIT sees them as immutable.
+        # The ids for the class with id i are at generalization_starts[i] until generalization_starts[i + 1].
+        self.generalizations = []
+        self.generalization_starts = []
+        for strategy_class in classes:
+            self.generalization_starts.append(len(self.generalizations))
+            for generalized in getattr(strategy_class, "_generalizations", None) or []:
+                self.generalizations.append(getattr(generalized, self.strategy_id_field))
+        self.generalization_starts.append(len(self.generalizations))
         
-        # Patch strategy class: Add polymorphic visitor function
-        def convert_storage_to(self, w_self, new_strategy):
-            getattr(new_strategy, funcname)(w_self, self)
-        strategy_class.convert_storage_to = convert_storage_to
+        # Map strategies storing their keys unboxed, in the order of self.strategies.
+        # GenericMapStrategy compares such keys by their unboxed value.
+        self.unboxed_key_strategies = [ self.strategy_singleton_instance(strategy_class)
+                for strategy_class in self.strategies if getattr(strategy_class, "unboxes_keys", False) ]
+    
+    def collect_slot_bytes(self):
+        "NOT_RPYTHON"
+        slot_bytes = []
+        for strategy_type in self.strategies:
+            strategy = self.strategy_singleton_instance(strategy_type)
+            if hasattr(strategy, "slot_bytes"):
+                slot_bytes.append(strategy.slot_bytes())
+            else:
+                slot_bytes.append(self.generic_slot_bytes)
+        return slot_bytes
+    
+    def overrides_storage_access(self):
+        "NOT_RPYTHON"
+        cls = self.__class__
+        return cls.get_storage.im_func is not StrategyFactory.get_storage.im_func or \
+                cls.set_storage.im_func is not StrategyFactory.set_storage.im_func
+    
+    def route_storage_access(self, strategy_class):
+        "NOT_RPYTHON"
+        # Note: this affects all factories sharing strategy_class.
+        erase, unerase = erasing_pairs[strategy_class]
+        get_storage, set_storage = make_storage_accessors(erase, unerase, True)
+        strategy_class.get_storage = get_storage
+        strategy_class.set_storage = set_storage
+    
+    def unique_classes(self, classes):
+        "NOT_RPYTHON"
+        result = []
+        seen = set()
+        for cls in classes:
+            if cls not in seen:
+                seen.add(cls)
+                result.append(cls)
+        return result
     
     def collect_subclasses(self, cls):
         "NOT_RPYTHON"
+        # Depth-first, iteratively. Classes reachable through multiple bases are only listed once.
         subclasses = []
-        for subcls in cls.__subclasses__():
+        seen = set()
+        pending = list(reversed(cls.__subclasses__()))
+        while pending:
+            subcls = pending.pop()
+            if subcls in seen:
+                continue
+            seen.add(subcls)
             subclasses.append(subcls)
-            subclasses.extend(self.collect_subclasses(subcls))
+            pending.extend(reversed(subcls.__subclasses__()))
         return subclasses
     
     def order_strategies(self):
         "NOT_RPYTHON"
-        def get_generalization_depth(strategy, visited=None):
-            if visited is None:
-                visited = set()
-            if strategy._generalizations:
-                if strategy in visited:
-                    raise Exception("Cycle in generalization-tree of %s" % strategy)
-                visited.add(strategy)
-                depth = 0
-                for generalization in strategy._generalizations:
-                    other_depth = get_generalization_depth(generalization, visited)
-                    depth = max(depth, other_depth)
-                return depth + 1
-            else:
-                return 0
-        self.strategies.sort(key=get_generalization_depth, reverse=True)
+        # Sort the strategies by their generalization depth: the length of the longest chain of
+        # generalizations starting at a strategy. The depths are computed in a single
+        # topological pass, starting with the strategies without generalizations.
+        generalizations = {}
+        specializations = {}
+        for strategy in self.strategies:
+            specializations[strategy] = []
+        for strategy in self.strategies:
+            generalizations[strategy] = getattr(strategy, "_generalizations", None) or []
+            for generalized in generalizations[strategy]:
+                if generalized not in specializations:
+                    raise Exception("%s generalizes to %s, which is not a strategy of this factory" % (strategy, generalized))
+                specializations[generalized].append(strategy)
+        
+        unresolved = dict([ (strategy, len(generalizations[strategy])) for strategy in self.strategies ])
+        ready = [ strategy for strategy in self.strategies if unresolved[strategy] == 0 ]
+        depths = {}
+        while ready:
+            strategy = ready.pop()
+            depths[strategy] = max([ depths[generalized] + 1 for generalized in generalizations[strategy] ] or [0])
+            for specialized in specializations[strategy]:
+                unresolved[specialized] -= 1
+                if unresolved[specialized] == 0:
+                    ready.append(specialized)
+        if len(depths) < len(self.strategies):
+            cycle = [ strategy for strategy in self.strategies if strategy not in depths ]
+            raise Exception("Cycle in generalization-tree of %s" % cycle)
+        
+        # Strategies, which are not connected to any other strategy through generalizations.
+        # They can only be used through set_initial_strategy, never by switching strategies.
+        self.unreachable_strategies = [ strategy for strategy in self.strategies
+                    if not generalizations[strategy] and not specializations[strategy] ]
+        self.strategies.sort(key=depths.get, reverse=True)
     
     @jit.elidable
     def strategy_singleton_instance(self, strategy_class):
@@ -268,36 +620,68 @@ class AbstractStrategy(object):
         # of w_self was switched to self.
         pass
     
+    def profile(self, w_self, operation, elements):
+        # Count an access to w_self, if profiling is activated in the logger (see Logger.activate_profiling).
+        # Accesses are counted once, by the strategy called by the VM, even if it generalizes on the way.
+        # Without profiling, this is a single check of a quasi-immutable flag.
+        if rstrategies_logger.profiling_flag.active:
+            self.strategy_factory().profile_access(w_self, self, operation, elements)
+    
     # Main Fixedsize API
     
     def store(self, w_self, index0, value):
-        raise NotImplementedError("Abstract method")
+        self.profile(w_self, rstrategies_logger.PROFILE_STORE, 1)
+        self.check_index_store(w_self, index0)
+        if self.check_can_handle(value):
+            self._store(w_self, index0, value)
+        else:
+            self.cannot_handle_store(w_self, index0, value)
     
     def fetch(self, w_self, index0):
-        raise NotImplementedError("Abstract method")
+        self.profile(w_self, rstrategies_logger.PROFILE_FETCH, 1)
+        self.check_index_fetch(w_self, index0)
+        return self._fetch(w_self, index0)
     
     def size(self, w_self):
         raise NotImplementedError("Abstract method")
     
+    def slot_bytes(self):
+        # Estimated number of bytes used per element, for memory accounting in the log.
+        # By default, elements cost as much as without strategies.
+        return self.strategy_factory().generic_slot_bytes
+    
     # Fixedsize utility methods
+    # The index range is checked once per operation, not once per element.
     
     def slice(self, w_self, start, end):
-        return [ self.fetch(w_self, i) for i in range(start, end)]
+        self.profile(w_self, rstrategies_logger.PROFILE_SLICE, end - start)
+        self.check_index_range(w_self, start, end)
+        return [ self._fetch(w_self, i) for i in range(start, end)]
     
     def fetch_all(self, w_self):
-        return self.slice(w_self, 0, self.size(w_self))
+        self.profile(w_self, rstrategies_logger.PROFILE_SLICE, self.size(w_self))
+        return [ self._fetch(w_self, i) for i in range(self.size(w_self))]
     
     def store_all(self, w_self, elements):
-        for i, e in enumerate(elements):
-            self.store(w_self, i, e)
+        self.profile(w_self, rstrategies_logger.PROFILE_STORE, len(elements))
+        self.check_index_range(w_self, 0, len(elements))
+        strategy = self
+        for i in range(len(elements)):
+            value = elements[i]
+            if not strategy.check_can_handle(value):
+                strategy = strategy.generalize_for_value(w_self, value)
+            strategy._store(w_self, i, value)
     
     # Main Varsize API
     
     def insert(self, w_self, index0, list_w):
-        raise NotImplementedError("Abstract method")
+        self.profile(w_self, rstrategies_logger.PROFILE_INSERT, len(list_w))
+        self._insert(w_self, index0, list_w)
     
     def delete(self, w_self, start, end):
-        raise NotImplementedError("Abstract method")
+        self.profile(w_self, rstrategies_logger.PROFILE_DELETE, end - start)
+        self.check_index_range(w_self, start, end)
+        self._delete(w_self, start, end)
     
     # Varsize utility methods
     
@@ -305,9 +689,26 @@ class AbstractStrategy(object):
         self.insert(w_self, self.size(w_self), list_w)        
     
     def pop(self, w_self, index0):
-        e = self.fetch(w_self, index0)
-        self.delete(w_self, index0, index0+1)
+        self.profile(w_self, rstrategies_logger.PROFILE_DELETE, 1)
+        self.check_index_range(w_self, index0, index0 + 1)
+        e = self._fetch(w_self, index0)
+        self._delete(w_self, index0, index0 + 1)
         return e
+    
+    # Element access without index checks. _store is only called with values accepted by check_can_handle.
+    
+    def _fetch(self, w_self, index0):
+        raise NotImplementedError("Abstract method")
+    
+    def _store(self, w_self, index0, value):
+        raise NotImplementedError("Abstract method")
+    
+    def _delete(self, w_self, start, end):
+        raise NotImplementedError("Abstract method")
+    
+    def _insert(self, w_self, index0, list_w):
+        # Generalizes the strategy if necessary. Indexes beyond the end append the elements.
+        raise NotImplementedError("Abstract method")
 
     # Internal methods
     
@@ -317,18 +718,55 @@ class AbstractStrategy(object):
     def check_can_handle(self, value):
         raise NotImplementedError("Abstract method")
     
+    def check_can_handle_storage(self, unwrapped_storage):
+        # Overwrite this method to validate a buffer of unwrapped values
+        # passed to StrategyFactory.set_initial_strategy_unwrapped().
+        return True
+    
+    def initialize_storage_unwrapped(self, w_self, unwrapped_storage):
+        raise NotImplementedError("Abstract method")
+    
+    def wrap_storage(self, unwrapped_storage):
+        # Return the list of wrapped values contained in a buffer of unwrapped values.
+        raise NotImplementedError("Abstract method")
+    
+    def size_of_storage(self, unwrapped_storage):
+        # Return the number of values contained in a buffer of unwrapped values.
+        return len(unwrapped_storage)
+    
+    def can_adopt_storage(self, unwrapped_storage):
+        # Return True if initialize_storage_unwrapped can use the buffer as storage without copying it.
+        return isinstance(unwrapped_storage, list)
+    
+    def copy_storage(self, unwrapped_storage):
+        # Return a copy of a buffer of unwrapped values, in the format of initialize_storage_unwrapped.
+        return list(unwrapped_storage)
+    
+    # Raw storage export, see StrategyFactory.export_raw
+    
+    def export_raw(self, w_self):
+        raise NotImplementedError("Abstract method")
+    
+    def import_raw(self, w_self, raw_storage):
+        raise NotImplementedError("Abstract method")
+    
     def convert_storage_to(self, w_self, new_strategy):
-        # This will be overwritten in patch_strategy_class
-        new_strategy.convert_storage_from(w_self, self)
+        self.strategy_factory().convert_storage(w_self, self, new_strategy)
     
-    @jit.unroll_safe
+    @jit.look_inside_iff(unroll_conversion)
     def convert_storage_from(self, w_self, previous_strategy):
         # This is a very unefficient (but most generic) way to do this.
         # Subclasses should specialize.
-        storage = previous_strategy.fetch_all(w_self)
-        self.initialize_storage(w_self, previous_strategy.size(w_self))
+        # Conversions use the internal accessors, so they are not counted as profiled accesses.
+        size = previous_strategy.size(w_self)
+        previous_strategy.check_index_range(w_self, 0, size)
+        storage = [ previous_strategy._fetch(w_self, i) for i in range(size) ]
+        self.initialize_storage(w_self, size)
         for i, field in enumerate(storage):
-            self.store(w_self, i, field)
+            self._store(w_self, i, field)
+    
+    def generalized_strategy_for(self, value):
+        return self.strategy_factory().generalized_strategy_for(self, value)
     
     def generalize_for_value(self, w_self, value):
         strategy_type = self.generalized_strategy_for(value)
@@ -337,12 +775,12 @@ class AbstractStrategy(object):
         
     def cannot_handle_store(self, w_self, index0, value):
         new_instance = self.generalize_for_value(w_self, value)
-        new_instance.store(w_self, index0, value)
+        new_instance._store(w_self, index0, value)
         
     def cannot_handle_insert(self, w_self, index0, list_w):
         # TODO - optimize. Prevent multiple generalizations and slicing done by callers.
         new_strategy = self.generalize_for_value(w_self, list_w[0])
-        new_strategy.insert(w_self, index0, list_w)
+        new_strategy._insert(w_self, index0, list_w)
 
 # ============== Special Strategies with no storage array ==============
 
@@ -353,18 +791,37 @@ class EmptyStrategy(AbstractStrategy):
     def initialize_storage(self, w_self, initial_size):
         assert initial_size == 0
         self.set_storage(w_self, None)
+    def initialize_storage_unwrapped(self, w_self, unwrapped_storage):
+        assert len(unwrapped_storage) == 0
+        self.set_storage(w_self, None)
+    def can_adopt_storage(self, unwrapped_storage):
+        return True
+    def wrap_storage(self, unwrapped_storage):
+        return []
+    def export_raw(self, w_self):
+        return None
+    def import_raw(self, w_self, raw_storage):
+        self.set_storage(w_self, None)
     def convert_storage_from(self, w_self, previous_strategy):
         self.set_storage(w_self, None)
     def fetch(self, w_self, index0):
+        self.profile(w_self, rstrategies_logger.PROFILE_FETCH, 1)
         raise IndexError
     def store(self, w_self, index0, value):
+        self.profile(w_self, rstrategies_logger.PROFILE_STORE, 1)
         self.cannot_handle_insert(w_self, index0, [value])
-    def insert(self, w_self, index0, list_w):
+    def _insert(self, w_self, index0, list_w):
         self.cannot_handle_insert(w_self, index0, list_w)
-    def delete(self, w_self, start, end):
-        self.check_index_range(w_self, start, end)
+    def _fetch(self, w_self, index0):
+        raise IndexError
+    def _store(self, w_self, index0, value):
+        raise IndexError
+    def _delete(self, w_self, start, end):
+        pass
     def size(self, w_self):
         return 0
+    def slot_bytes(self):
+        return 0
     def check_can_handle(self, value):
         return False
 
@@ -386,17 +843,40 @@ class SingleValueStrategy(AbstractStrategy):
     def convert_storage_from(self, w_self, previous_strategy):
         self.initialize_storage(w_self, previous_strategy.size(w_self))
     
-    def fetch(self, w_self, index0):
-        self.check_index_fetch(w_self, index0)
+    # Nothing is unboxed, so a buffer of unwrapped values contains the single value.
+    @jit.look_inside_iff(unroll_objects)
+    def check_can_handle_storage(self, unwrapped_storage):
+        value = self.value()
+        for element in unwrapped_storage:
+            if element is not value:
+                return False
+        return True
+    def initialize_storage_unwrapped(self, w_self, unwrapped_storage):
+        self.initialize_storage(w_self, len(unwrapped_storage))
+    def can_adopt_storage(self, unwrapped_storage):
+        # Only the size of the buffer is used.
+        return True
+    def wrap_storage(self, unwrapped_storage):
+        return list(unwrapped_storage)
+    
+    def export_raw(self, w_self):
+        return (self.value(), self.size(w_self))
+    def import_raw(self, w_self, raw_storage):
+        value, size = raw_storage
+        assert value is self.value()
+        self.initialize_storage(w_self, size)
+    
+    def _fetch(self, w_self, index0):
         return self.value()
-    def store(self, w_self, index0, value):
-        self.check_index_store(w_self, index0)
-        if self.check_can_handle(value):
-            return
-        self.cannot_handle_store(w_self, index0, value)
+    def _store(self, w_self, index0, value):
+        pass
+    def slice(self, w_self, start, end):
+        self.profile(w_self, rstrategies_logger.PROFILE_SLICE, end - start)
+        self.check_index_range(w_self, start, end)
+        return [self.value()] * (end - start)
     
-    @jit.unroll_safe
-    def insert(self, w_self, index0, list_w):
+    @jit.look_inside_iff(unroll_elements)
+    def _insert(self, w_self, index0, list_w):
         storage_obj = self.get_storage(w_self)
         for i in range(len(list_w)):
             if self.check_can_handle(list_w[i]):
@@ -405,11 +885,12 @@ class SingleValueStrategy(AbstractStrategy):
                 self.cannot_handle_insert(w_self, index0 + i, list_w[i:])
                 return
     
-    def delete(self, w_self, start, end):
-        self.check_index_range(w_self, start, end)
+    def _delete(self, w_self, start, end):
         self.get_storage(w_self).size -= (end - start)
     def size(self, w_self):
         return self.get_storage(w_self).size
+    def slot_bytes(self):
+        return 0
     def check_can_handle(self, value):
         return value is self.value()
     
@@ -425,26 +906,44 @@ class StrategyWithStorage(AbstractStrategy):
         default = self._unwrap(self.default_value())
         self.set_storage(w_self, [default] * initial_size)
     
-    @jit.unroll_safe
+    def initialize_storage_unwrapped(self, w_self, unwrapped_storage):
+        self.set_storage(w_self, unwrapped_storage)
+    
+    def wrap_storage(self, unwrapped_storage):
+        return [ self._wrap(value) for value in unwrapped_storage ]
+    
+    def export_raw(self, w_self):
+        return self.get_storage(w_self)
+    
+    def import_raw(self, w_self, raw_storage):
+        self.initialize_storage_unwrapped(w_self, raw_storage)
+    
+    @jit.look_inside_iff(unroll_conversion)
     def convert_storage_from(self, w_self, previous_strategy):
         size = previous_strategy.size(w_self)
-        new_storage = [ self._unwrap(previous_strategy.fetch(w_self, i))
+        previous_strategy.check_index_range(w_self, 0, size)
+        new_storage = [ self._unwrap(previous_strategy._fetch(w_self, i))
                         for i in range(size) ]
         self.set_storage(w_self, new_storage)
     
-    def store(self, w_self, index0, wrapped_value):
-        self.check_index_store(w_self, index0)
-        if self.check_can_handle(wrapped_value):
-            unwrapped = self._unwrap(wrapped_value)
-            self.get_storage(w_self)[index0] = unwrapped
-        else:
-            self.cannot_handle_store(w_self, index0, wrapped_value)
+    def _store(self, w_self, index0, wrapped_value):
+        unwrapped = self._unwrap(wrapped_value)
+        self.get_storage(w_self)[index0] = unwrapped
     
-    def fetch(self, w_self, index0):
-        self.check_index_fetch(w_self, index0)
+    def _fetch(self, w_self, index0):
         unwrapped = self.get_storage(w_self)[index0]
         return self._wrap(unwrapped)
     
+    def slice(self, w_self, start, end):
+        self.profile(w_self, rstrategies_logger.PROFILE_SLICE, end - start)
+        self.check_index_range(w_self, start, end)
+        assert start >= 0 and end >= 0
+        return [ self._wrap(value) for value in self.get_storage(w_self)[start : end] ]
+    
+    def fetch_all(self, w_self):
+        self.profile(w_self, rstrategies_logger.PROFILE_SLICE, self.size(w_self))
+        return [ self._wrap(value) for value in self.get_storage(w_self) ]
+    
     def _wrap(self, value):
         raise NotImplementedError("Abstract method")
     
@@ -454,8 +953,8 @@ class StrategyWithStorage(AbstractStrategy):
     def size(self, w_self):
         return len(self.get_storage(w_self))
     
-    @jit.unroll_safe
-    def insert(self, w_self, start, list_w):
+    @jit.look_inside_iff(unroll_elements)
+    def _insert(self, w_self, start, list_w):
         if start > self.size(w_self):
             start = self.size(w_self)
         for i in range(len(list_w)):
@@ -465,8 +964,7 @@ class StrategyWithStorage(AbstractStrategy):
                 self.cannot_handle_insert(w_self, start + i, list_w[i:])
                 return
     
-    def delete(self, w_self, start, end):
-        self.check_index_range(w_self, start, end)
+    def _delete(self, w_self, start, end):
         assert start >= 0 and end >= 0
         del self.get_storage(w_self)[start : end]
         
@@ -481,18 +979,124 @@ class GenericStrategy(StrategyWithStorage):
     def check_can_handle(self, wrapped_value):
         return True
     
+class WeakGenericStrategyStorage(object):
+    """Storage of WeakGenericStrategy: the list of weak references, and the last created reference."""
+    _attrs_ = ['refs', 'last_ref']
+    def __init__(self, refs=None):
+        self.refs = refs
+        self.last_ref = None
+
 class WeakGenericStrategy(StrategyWithStorage):
     # == Required:
     # See StrategyWithStorage
     
+    # Fetching a collected object returns default_value().
+    # Dead references are not removed automatically, see count_live() and compact(),
+    # which find them by checking every reference.
+    # Slots referencing the same object share one weakref: the storage caches the last created
+    # reference, which covers the default value and objects stored repeatedly (e.g. by store_all).
+    # Storing the object already referenced by a slot keeps its weakref.
+    
     def _wrap(self, value):
-        return value() or self.default_value()
-    def _unwrap(self, value):
-        assert value is not None
-        return weakref.ref(value)
+        w_value = value()
+        if w_value is None:
+            return self.default_value()
+        return w_value
+    def new_ref(self, storage, w_value):
+        assert w_value is not None
+        ref = storage.last_ref
+        if ref is None or ref() is not w_value:
+            ref = weakref.ref(w_value)
+            storage.last_ref = ref
+        return ref
     def check_can_handle(self, wrapped_value):
         return True
     
+    def initialize_storage(self, w_self, initial_size):
+        storage = WeakGenericStrategyStorage()
+        storage.refs = [self.new_ref(storage, self.default_value())] * initial_size
+        self.set_storage(w_self, storage)
+    
+    def initialize_storage_unwrapped(self, w_self, unwrapped_storage):
+        # unwrapped_storage is a list of weakrefs, as returned by export_raw.
+        self.set_storage(w_self, WeakGenericStrategyStorage(unwrapped_storage))
+    
+    def export_raw(self, w_self):
+        return self.get_storage(w_self).refs
+    
+    @jit.look_inside_iff(unroll_conversion)
+    def convert_storage_from(self, w_self, previous_strategy):
+        size = previous_strategy.size(w_self)
+        previous_strategy.check_index_range(w_self, 0, size)
+        storage = WeakGenericStrategyStorage()
+        storage.refs = [ self.new_ref(storage, previous_strategy._fetch(w_self, i)) for i in range(size) ]
+        self.set_storage(w_self, storage)
+    
+    def _store(self, w_self, index0, wrapped_value):
+        storage = self.get_storage(w_self)
+        # Avoid allocating a new weakref when storing the same object again.
+        if storage.refs[index0]() is not wrapped_value:
+            storage.refs[index0] = self.new_ref(storage, wrapped_value)
+    
+    def _fetch(self, w_self, index0):
+        return self._wrap(self.get_storage(w_self).refs[index0])
+    
+    def slice(self, w_self, start, end):
+        self.profile(w_self, rstrategies_logger.PROFILE_SLICE, end - start)
+        self.check_index_range(w_self, start, end)
+        assert start >= 0 and end >= 0
+        return [ self._wrap(ref) for ref in self.get_storage(w_self).refs[start : end] ]
+    
+    def fetch_all(self, w_self):
+        self.profile(w_self, rstrategies_logger.PROFILE_SLICE, self.size(w_self))
+        return [ self._wrap(ref) for ref in self.get_storage(w_self).refs ]
+    
+    def size(self, w_self):
+        return len(self.get_storage(w_self).refs)
+    
+    @jit.look_inside_iff(unroll_elements)
+    def _insert(self, w_self, start, list_w):
+        storage = self.get_storage(w_self)
+        if start > len(storage.refs):
+            start = len(storage.refs)
+        for i in range(len(list_w)):
+            storage.refs.insert(start + i, self.new_ref(storage, list_w[i]))
+    
+    def _delete(self, w_self, start, end):
+        assert start >= 0 and end >= 0
+        del self.get_storage(w_self).refs[start : end]
+    
+    def count_live(self, w_self):
+        """Return the number of elements, that have not been garbage collected."""
+        live = 0
+        for ref in self.get_storage(w_self).refs:
+            if ref() is not None:
+                live += 1
+        return live
+    
+    def compact(self, w_self, start=0, end=-1):
+        """
+        Remove the dead references in the range [start, end) and return the number of removed elements.
+        The indices of all following elements change accordingly. Compacting a limited range at a time
+        keeps the pause short for large collections. The references are compacted in place.
+        """
+        refs = self.get_storage(w_self).refs
+        if end < 0:
+            end = len(refs)
+        if start < 0 or end < start or end > len(refs):
+            raise IndexError
+        # Move the live references down, then delete the remaining slots of the range.
+        live_end = start
+        for i in range(start, end):
+            ref = refs[i]
+            if ref() is not None:
+                refs[live_end] = ref
+                live_end += 1
+        removed = end - live_end
+        if removed > 0:
+            del refs[live_end : end]
+        return removed
+    
 # ============== Mixins for index checking operations ==============
 
 class SafeIndexingMixin(object):
@@ -501,10 +1105,9 @@ class SafeIndexingMixin(object):
     def check_index_fetch(self, w_self, index0):
         self.check_index(w_self, index0)
     def check_index_range(self, w_self, start, end):
-        if end < start:
+        # Check the interval [start, end) with a single size read.
+        if start < 0 or end < start or end > self.size(w_self):
             raise IndexError
-        self.check_index(w_self, start)
-        self.check_index(w_self, end)
     def check_index(self, w_self, index0):
         if index0 < 0 or index0 >= self.size(w_self):
             raise IndexError
@@ -529,15 +1132,34 @@ class SpecializedStrategy(StrategyWithStorage):
         return self.unwrap(value)
     def _wrap(self, value):
         return self.wrap(value)
+    def slot_bytes(self):
+        # Unboxed values are assumed to take one word. Overwrite this for smaller types.
+        return WORD
     
 class SingleTypeStrategy(SpecializedStrategy):
     # == Required Functions:
     # See SpecializedStrategy
     # contained_type - The wrapped type that can be stored in this strategy
     
+    # == Optional:
+    # unwrapped_type - The type of the unboxed values (like int or float). If set, buffers passed to
+    #     StrategyFactory.set_initial_strategy_unwrapped are checked in a single pass before being adopted.
+    unwrapped_type = None
+    
     def check_can_handle(self, value):
         return isinstance(value, self.contained_type)
     
+    def check_can_handle_storage(self, unwrapped_storage):
+        if self.unwrapped_type is None:
+            return True
+        for value in unwrapped_storage:
+            if not self.check_can_handle_unwrapped(value):
+                return False
+        return True
+    
+    def check_can_handle_unwrapped(self, value):
+        return isinstance(value, self.unwrapped_type)
+    
 class TaggingStrategy(SingleTypeStrategy):
     """This strategy uses a special tag value to represent a single additional object."""
     # == Required:
@@ -559,3 +1181,475 @@ class TaggingStrategy(SingleTypeStrategy):
         if value == self.unwrapped_tagged_value():
             return self.wrapped_tagged_value()
         return self.wrap(value)
+
+class StructOfArraysStrategy(AbstractStrategy):
+    """
+    This strategy stores records with a fixed number of unboxed fields of the same type
+    (like points or pairs of ints) in one unboxed array per field, instead of storing the record objects.
+    """
+    # == Required:
+    # See AbstractStrategy
+    # check_index_*(...) - use mixin SafeIndexingMixin or UnsafeIndexingMixin
+    # contained_type - The wrapped record type that can be stored in this strategy
+    # field_count - The number of fields of every record, must be constant
+    # default_value(self) - The record to be initially contained in this strategy
+    # check_can_handle_field(self, value, field) - Return True if the given field of the record value
+    #     can be stored unboxed (e.g. it is an int). Otherwise, the collection is generalized.
+    # unwrap_field(self, value, field) - Return the unboxed value of the given field of the record value
+    # wrap_fields(self, fields) - Return a record object for the list of unboxed field values
+    
+    @jit.unroll_safe
+    def initialize_storage(self, w_self, initial_size):
+        default = self.default_value()
+        storage = [ [self.unwrap_field(default, field)] * initial_size for field in range(self.field_count) ]
+        self.set_storage(w_self, storage)
+    
+    def initialize_storage_unwrapped(self, w_self, unwrapped_storage):
+        # unwrapped_storage is a list of arrays of equal length, one for every field.
+        assert len(unwrapped_storage) == self.field_count
+        self.set_storage(w_self, unwrapped_storage)
+    
+    @jit.unroll_safe
+    def wrap_storage(self, unwrapped_storage):
+        return [ self.wrap_fields([ unwrapped_storage[field][i] for field in range(self.field_count) ])
+                for i in range(self.size_of_storage(unwrapped_storage)) ]
+    
+    def size_of_storage(self, unwrapped_storage):
+        return len(unwrapped_storage[0])
+    
+    def can_adopt_storage(self, unwrapped_storage):
+        for values in unwrapped_storage:
+            if not isinstance(values, list):
+                return False
+        return isinstance(unwrapped_storage, list)
+    
+    def copy_storage(self, unwrapped_storage):
+        return [ list(values) for values in unwrapped_storage ]
+    
+    def export_raw(self, w_self):
+        return self.get_storage(w_self)
+    
+    def import_raw(self, w_self, raw_storage):
+        self.initialize_storage_unwrapped(w_self, raw_storage)
+    
+    @jit.look_inside_iff(unroll_conversion)
+    def convert_storage_from(self, w_self, previous_strategy):
+        size = previous_strategy.size(w_self)
+        previous_strategy.check_index_range(w_self, 0, size)
+        storage = [ [] for _ in range(self.field_count) ]
+        for i in range(size):
+            value = previous_strategy._fetch(w_self, i)
+            for field in range(self.field_count):
+                storage[field].append(self.unwrap_field(value, field))
+        self.set_storage(w_self, storage)
+    
+    @jit.unroll_safe
+    def _store(self, w_self, index0, wrapped_value):
+        storage = self.get_storage(w_self)
+        for field in range(self.field_count):
+            storage[field][index0] = self.unwrap_field(wrapped_value, field)
+    
+    @jit.unroll_safe
+    def _fetch(self, w_self, index0):
+        storage = self.get_storage(w_self)
+        return self.wrap_fields([ storage[field][index0] for field in range(self.field_count) ])
+    
+    def size(self, w_self):
+        return len(self.get_storage(w_self)[0])
+    
+    def slot_bytes(self):
+        return self.field_count * WORD
+    
+    @jit.look_inside_iff(unroll_elements)
+    def _insert(self, w_self, start, list_w):
+        if start > self.size(w_self):
+            start = self.size(w_self)
+        storage = self.get_storage(w_self)
+        for i in range(len(list_w)):
+            if self.check_can_handle(list_w[i]):
+                for field in range(self.field_count):
+                    storage[field].insert(start + i, self.unwrap_field(list_w[i], field))
+            else:
+                self.cannot_handle_insert(w_self, start + i, list_w[i:])
+                return
+    
+    @jit.unroll_safe
+    def _delete(self, w_self, start, end):
+        assert start >= 0 and end >= 0
+        storage = self.get_storage(w_self)
+        for field in range(self.field_count):
+            del storage[field][start : end]
+    
+    @jit.unroll_safe
+    def check_can_handle(self, value):
+        if not isinstance(value, self.contained_type):
+            return False
+        for field in range(self.field_count):
+            if not self.check_can_handle_field(value, field):
+                return False
+        return True
+    
+    # Bulk field access, without creating record objects
+    
+    def fetch_field(self, w_self, field):
+        """Return the array of unboxed values of the given field. This is not a copy and must not be resized."""
+        return self.get_storage(w_self)[field]
+    
+    def fetch_field_value(self, w_self, index0, field):
+        self.check_index_fetch(w_self, index0)
+        return self.get_storage(w_self)[field][index0]
+    
+    def store_field_value(self, w_self, index0, field, unwrapped_value):
+        self.check_index_store(w_self, index0)
+        self.get_storage(w_self)[field][index0] = unwrapped_value
+
+class StringStrategyStorage(object):
+    """Storage of StringStrategy: the contents as host string, as list of characters, or both."""
+    _attrs_ = ['string', 'chars']
+    def __init__(self, string):
+        self.string = string
+        self.chars = None
+    def get_string(self):
+        if self.string is None:
+            self.string = "".join(self.chars)
+        return self.string
+    def get_chars(self):
+        # The characters are about to be modified, so the string becomes invalid.
+        if self.chars is None:
+            self.chars = list(self.string)
+        self.string = None
+        return self.chars
+    def size(self):
+        if self.string is not None:
+            return len(self.string)
+        return len(self.chars)
+    def char_at(self, index0):
+        if self.string is not None:
+            return self.string[index0]
+        return self.chars[index0]
+
+class StringStrategy(AbstractStrategy):
+    """
+    This strategy stores characters in a host string. Host strings can be imported and exported
+    without copying (see StrategyFactory.set_initial_strategy_unwrapped and export_raw).
+    The first modification converts the contents to a list of characters, which is joined
+    into a string again on the next export.
+    """
+    # == Required:
+    # See AbstractStrategy
+    # check_index_*(...) - use mixin SafeIndexingMixin or UnsafeIndexingMixin
+    # contained_type - The wrapped character type that can be stored in this strategy
+    # default_value(self) - The character to be initially contained in this strategy
+    # wrap(self, char) - Return the wrapped character. To avoid allocations, this should return interned objects.
+    # unwrap(self, value) - Return the host character of the wrapped character value
+    
+    def initialize_storage(self, w_self, initial_size):
+        string = self.unwrap(self.default_value()) * initial_size
+        self.set_storage(w_self, StringStrategyStorage(string))
+    
+    def initialize_storage_unwrapped(self, w_self, unwrapped_storage):
+        # unwrapped_storage must be a host string. Strings are immutable and never need to be copied.
+        assert isinstance(unwrapped_storage, str)
+        self.set_storage(w_self, StringStrategyStorage(unwrapped_storage))
+    
+    def wrap_storage(self, unwrapped_storage):
+        return [ self.wrap(char) for char in unwrapped_storage ]
+    
+    def can_adopt_storage(self, unwrapped_storage):
+        return isinstance(unwrapped_storage, str)
+    
+    def copy_storage(self, unwrapped_storage):
+        # Strings are not copied. Other buffers (like lists of characters) are joined into a string.
+        if isinstance(unwrapped_storage, str):
+            return unwrapped_storage
+        return "".join(unwrapped_storage)
+    
+    def export_raw(self, w_self):
+        return self.get_storage(w_self).get_string()
+    
+    def import_raw(self, w_self, raw_storage):
+        self.initialize_storage_unwrapped(w_self, raw_storage)
+    
+    @jit.look_inside_iff(unroll_conversion)
+    def convert_storage_from(self, w_self, previous_strategy):
+        size = previous_strategy.size(w_self)
+        previous_strategy.check_index_range(w_self, 0, size)
+        chars = [ self.unwrap(previous_strategy._fetch(w_self, i)) for i in range(size) ]
+        self.set_storage(w_self, StringStrategyStorage("".join(chars)))
+    
+    def _store(self, w_self, index0, wrapped_value):
+        self.get_storage(w_self).get_chars()[index0] = self.unwrap(wrapped_value)
+    
+    def _fetch(self, w_self, index0):
+        return self.wrap(self.get_storage(w_self).char_at(index0))
+    
+    def size(self, w_self):
+        return self.get_storage(w_self).size()
+    
+    def slot_bytes(self):
+        return 1
+    
+    @jit.look_inside_iff(unroll_elements)
+    def _insert(self, w_self, start, list_w):
+        if start > self.size(w_self):
+            start = self.size(w_self)
+        for i in range(len(list_w)):
+            if self.check_can_handle(list_w[i]):
+                self.get_storage(w_self).get_chars().insert(start + i, self.unwrap(list_w[i]))
+            else:
+                self.cannot_handle_insert(w_self, start + i, list_w[i:])
+                return
+    
+    def _delete(self, w_self, start, end):
+        assert start >= 0 and end >= 0
+        del self.get_storage(w_self).get_chars()[start : end]
+    
+    def check_can_handle(self, value):
+        return isinstance(value, self.contained_type)
+
+# ============== Map Strategies ==============
+
+class AbstractMapStrategy(object):
+    """
+    Strategies for key/value maps. They are used like the strategies for
+    indexed collections, with a separate root class and StrategyFactory.
+    == Required:
+    strategy_factory(self) - Access to StorageFactory
+    """
+    
+    def strategy_switched(self, w_self):
+        # Overwrite this method for a hook whenever the strategy
+        # of w_self was switched to self.
+        pass
+    
+    # Main API
+    
+    def lookup(self, w_self, w_key, w_default=None):
+        raise NotImplementedError("Abstract method")
+    
+    def put(self, w_self, w_key, w_value):
+        raise NotImplementedError("Abstract method")
+    
+    def remove(self, w_self, w_key):
+        # Raise KeyError if w_key is not contained
+        raise NotImplementedError("Abstract method")
+    
+    def size(self, w_self):
+        raise NotImplementedError("Abstract method")
+    
+    def slot_bytes(self):
+        # Estimated number of bytes used per entry, see AbstractStrategy.slot_bytes
+        return self.strategy_factory().generic_slot_bytes
+    
+    def items(self, w_self):
+        # Return a list of (w_key, w_value) tuples
+        raise NotImplementedError("Abstract method")
+    
+    # Utility methods
+    
+    def contains(self, w_self, w_key):
+        return self.lookup(w_self, w_key) is not None
+    
+    def keys(self, w_self):
+        return [ w_key for w_key, _ in self.items(w_self) ]
+    
+    def values(self, w_self):
+        return [ w_value for _, w_value in self.items(w_self) ]
+    
+    # Internal methods
+    
+    def initialize_storage(self, w_self, initial_size):
+        raise NotImplementedError("Abstract method")
+    
+    def check_can_handle_entry(self, w_key, w_value):
+        raise NotImplementedError("Abstract method")
+    
+    # Set by strategies storing keys unboxed, which must implement unboxed_key_eq and unboxed_key_hash.
+    unboxes_keys = False
+    
+    def unboxed_key_eq(self, w_key1, w_key2):
+        raise NotImplementedError("Abstract method")
+    
+    def unboxed_key_hash(self, w_key):
+        raise NotImplementedError("Abstract method")
+    
+    def convert_storage_to(self, w_self, new_strategy):
+        self.strategy_factory().convert_storage(w_self, self, new_strategy)
+    
+    def convert_storage_from(self, w_self, previous_strategy):
+        raise NotImplementedError("Abstract method")
+    
+    def generalize_for_entry(self, w_self, w_key, w_value):
+        factory = self.strategy_factory()
+        strategy_type = factory.generalized_strategy_for_entry(self, w_key, w_value)
+        return factory.switch_strategy(w_self, strategy_type, new_element=w_value)
+    
+    def cannot_handle_put(self, w_self, w_key, w_value):
+        new_strategy = self.generalize_for_entry(w_self, w_key, w_value)
+        new_strategy.put(w_self, w_key, w_value)
+
+class EmptyMapStrategy(AbstractMapStrategy):
+    # == Required:
+    # See AbstractMapStrategy
+    
+    def initialize_storage(self, w_self, initial_size):
+        assert initial_size == 0
+        self.set_storage(w_self, None)
+    def convert_storage_from(self, w_self, previous_strategy):
+        assert previous_strategy.size(w_self) == 0
+        self.set_storage(w_self, None)
+    def lookup(self, w_self, w_key, w_default=None):
+        return w_default
+    def put(self, w_self, w_key, w_value):
+        self.cannot_handle_put(w_self, w_key, w_value)
+    def remove(self, w_self, w_key):
+        raise KeyError
+    def size(self, w_self):
+        return 0
+    def slot_bytes(self):
+        return 0
+    def items(self, w_self):
+        return []
+    def check_can_handle_entry(self, w_key, w_value):
+        return False
+
+class MapStrategyWithStorage(AbstractMapStrategy):
+    # == Required:
+    # See AbstractMapStrategy
+    # new_storage(self) - Return a new, empty dict
+    # _wrap_key(self, key), _unwrap_key(self, w_key) - Conversion of keys, see StrategyWithStorage
+    # _wrap_value(self, value), _unwrap_value(self, w_value) - Conversion of values
+    # check_can_handle_key(self, w_key), check_can_handle_value(self, w_value)
+    
+    def initialize_storage(self, w_self, initial_size):
+        self.set_storage(w_self, self.new_storage())
+    
+    def convert_storage_from(self, w_self, previous_strategy):
+        # All entries must be compatible with self. This is the case when switching
+        # to a generalized strategy.
+        storage = self.new_storage()
+        for w_key, w_value in previous_strategy.items(w_self):
+            assert self.check_can_handle_entry(w_key, w_value)
+            storage[self._unwrap_key(w_key)] = self._unwrap_value(w_value)
+        self.set_storage(w_self, storage)
+    
+    def lookup(self, w_self, w_key, w_default=None):
+        if not self.check_can_handle_key(w_key):
+            return w_default
+        try:
+            value = self.get_storage(w_self)[self._unwrap_key(w_key)]
+        except KeyError:
+            return w_default
+        return self._wrap_value(value)
+    
+    def put(self, w_self, w_key, w_value):
+        if self.check_can_handle_entry(w_key, w_value):
+            self.get_storage(w_self)[self._unwrap_key(w_key)] = self._unwrap_value(w_value)
+        else:
+            self.cannot_handle_put(w_self, w_key, w_value)
+    
+    def remove(self, w_self, w_key):
+        if not self.check_can_handle_key(w_key):
+            raise KeyError
+        del self.get_storage(w_self)[self._unwrap_key(w_key)]
+    
+    def size(self, w_self):
+        return len(self.get_storage(w_self))
+    
+    def items(self, w_self):
+        return [ (self._wrap_key(key), self._wrap_value(value))
+                for key, value in self.get_storage(w_self).iteritems() ]
+    
+    def check_can_handle_entry(self, w_key, w_value):
+        return self.check_can_handle_key(w_key) and self.check_can_handle_value(w_value)
+    
+    def export_raw(self, w_self):
+        return self.get_storage(w_self)
+    
+    def import_raw(self, w_self, raw_storage):
+        self.set_storage(w_self, raw_storage)
+
+class GenericMapStrategy(MapStrategyWithStorage):
+    # == Required:
+    # See AbstractMapStrategy
+    # Keys that a SingleTypeKeyMapStrategy of the factory can handle are compared by their
+    # unboxed value, like in that strategy, so that entries stay reachable after switching
+    # to this strategy. Other keys are compared by identity.
+    # Overwrite key_eq and key_hash for other semantics.
+    
+    def new_storage(self):
+        return objectmodel.r_dict(self.key_eq, self.key_hash)
+    def key_eq(self, w_key1, w_key2):
+        if w_key1 is w_key2:
+            return True
+        strategy = self.unboxed_key_strategy_for(w_key1)
+        if strategy is None or not strategy.check_can_handle_key(w_key2):
+            return False
+        return strategy.unboxed_key_eq(w_key1, w_key2)
+    def key_hash(self, w_key):
+        strategy = self.unboxed_key_strategy_for(w_key)
+        if strategy is None:
+            return objectmodel.compute_identity_hash(w_key)
+        return strategy.unboxed_key_hash(w_key)
+    @jit.unroll_safe
+    def unboxed_key_strategy_for(self, w_key):
+        # Return the first strategy of the factory that stores w_key unboxed, or None.
+        for strategy in self.strategy_factory().unboxed_key_strategies:
+            if strategy.check_can_handle_key(w_key):
+                return strategy
+        return None
+    def _wrap_key(self, key):
+        return key
+    def _unwrap_key(self, w_key):
+        return w_key
+    def _wrap_value(self, value):
+        return value
+    def _unwrap_value(self, w_value):
+        return w_value
+    def check_can_handle_key(self, w_key):
+        return True
+    def check_can_handle_value(self, w_value):
+        return True
+
+class SingleTypeKeyMapStrategy(MapStrategyWithStorage):
+    # == Required:
+    # See AbstractMapStrategy
+    # contained_key_type - The wrapped type of keys that can be stored in this strategy
+    # wrap_key(self, key) - Return a boxed object for the primitive key
+    # unwrap_key(self, w_key) - Return the unboxed primitive value of w_key
+    
+    def new_storage(self):
+        return {}
+    def _wrap_key(self, key):
+        return self.wrap_key(key)
+    def _unwrap_key(self, w_key):
+        return self.unwrap_key(w_key)
+    def _wrap_value(self, value):
+        return value
+    def _unwrap_value(self, w_value):
+        return w_value
+    def check_can_handle_key(self, w_key):
+        return isinstance(w_key, self.contained_key_type)
+    def check_can_handle_value(self, w_value):
+        return True
+    unboxes_keys = True
+    def unboxed_key_eq(self, w_key1, w_key2):
+        return self.unwrap_key(w_key1) == self.unwrap_key(w_key2)
+    def unboxed_key_hash(self, w_key):
+        return objectmodel.compute_hash(self.unwrap_key(w_key))
+
+class SingleTypeMapStrategy(SingleTypeKeyMapStrategy):
+    # == Required:
+    # See SingleTypeKeyMapStrategy
+    # contained_value_type - The wrapped type of values that can be stored in this strategy
+    # wrap_value(self, value) - Return a boxed object for the primitive value
+    # unwrap_value(self, w_value) - Return the unboxed primitive value of w_value
+    
+    def _wrap_value(self, value):
+        return self.wrap_value(value)
+    def _unwrap_value(self, w_value):
+        return self.unwrap_value(w_value)
+    def check_can_handle_value(self, w_value):
+        return isinstance(w_value, self.contained_value_type)
+    def slot_bytes(self):
+        return 2 * WORD
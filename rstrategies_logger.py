@@ -1,54 +1,448 @@
+import time, os
+
+# Binary logs start with this header, followed by records. Every record starts with one of the tags.
+BINARY_MAGIC = "RSLOG\x01"
+TAG_STRING = 1  # id, length, characters
+TAG_ENTRY = 2   # cause, old strategy, new strategy, typename, slots, objects, number of element typenames, element typenames,
+                # number of histogram buckets, (bucket, objects) for every non-empty bucket
+TAG_COMMENT = 3 # comment string id
+# All numbers are encoded as unsigned varints. Strings are referenced by the id of a preceding string record.
+# Id 0 always refers to the empty string.
+
+# Operations counted in profiling mode, see Logger.activate_profiling()
+PROFILE_OPERATIONS = ["fetch", "store", "insert", "delete", "slice"]
+PROFILE_FETCH, PROFILE_STORE, PROFILE_INSERT, PROFILE_DELETE, PROFILE_SLICE = range(len(PROFILE_OPERATIONS))
+
+class ProfilingFlag(object):
+    """
+    Set when any logger activates profiling. Strategies check it before looking up their factory's logger.
+    """
+    _immutable_fields_ = ["active?"]
+    
+    def __init__(self):
+        self.active = False
+
+profiling_flag = ProfilingFlag()
+
+class LogSink(object):
+    """
+    Receives the output of a Logger.
+    """
+    _attrs_ = []
+    
+    def write_entry(self, cause, old_strategy, new_strategy, typename, slots, objects, element_typenames, histogram):
+        raise NotImplementedError("Abstract method")
+    
+    def write_comment(self, comment):
+        raise NotImplementedError("Abstract method")
+    
+    def flush(self):
+        pass
+
+def size_bucket(size):
+    """
+    Return the index of the logarithmic histogram bucket for the given collection size.
+    Bucket 0 holds empty collections, bucket b holds sizes from 2**(b-1) to 2**b - 1.
+    """
+    bucket = 0
+    while size > 0:
+        size >>= 1
+        bucket += 1
+    return bucket
+
+def typename_string(typename, site):
+    "The site is written as part of the typename: 'of <typename> at <site>'."
+    if site:
+        return "%s at %s" % (typename, site)
+    return typename
+
+def format_entry(cause, old_strategy, new_strategy, typename, slots, objects, element_typenames, histogram):
+    old_strategy_string = "%s -> " % old_strategy if old_strategy else ""
+    classname_string = " of %s" % typename if typename else ""
+    buckets = [ "%d:%d" % (bucket, histogram[bucket]) for bucket in range(len(histogram)) if histogram[bucket] ]
+    histogram_string = (" histogram " + ",".join(buckets)) if buckets else ""
+    element_string = (" elements: " + " ".join(element_typenames)) if element_typenames else ""
+    format = (cause, old_strategy_string, new_strategy, classname_string, slots, objects, histogram_string, element_string)
+    return "%s (%s%s)%s size %d objects %d%s%s" % format
+
+class PrintSink(LogSink):
+    """
+    Prints log entries in the text format to stdout. This is the default sink.
+    """
+    _attrs_ = []
+    
+    def write_entry(self, cause, old_strategy, new_strategy, typename, slots, objects, element_typenames, histogram):
+        print format_entry(cause, old_strategy, new_strategy, typename, slots, objects, element_typenames, histogram)
+    
+    def write_comment(self, comment):
+        print "# %s" % comment
+
+class BufferedSink(LogSink):
+    """
+    Collects output and writes it to a file descriptor in large batches.
+    flush() must be called before exiting, to write the remaining buffered output.
+    """
+    _attrs_ = ["fd", "buffer", "buffered", "buffer_size"]
+    
+    def __init__(self, fd, buffer_size=1 << 20):
+        self.fd = fd
+        self.buffer = []
+        self.buffered = 0
+        self.buffer_size = buffer_size
+    
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+    
+    def flush(self):
+        data = "".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        while data:
+            written = os.write(self.fd, data)
+            data = data[written:]
+
+class TextSink(BufferedSink):
+    """
+    Writes log entries in the text format to a file descriptor.
+    """
+    _attrs_ = []
+    
+    def write_entry(self, cause, old_strategy, new_strategy, typename, slots, objects, element_typenames, histogram):
+        self.write(format_entry(cause, old_strategy, new_strategy, typename, slots, objects, element_typenames, histogram) + "\n")
+    
+    def write_comment(self, comment):
+        self.write("# %s\n" % comment)
+
+def encode_varint(value):
+    assert value >= 0
+    chars = []
+    while value >= 0x80:
+        chars.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    chars.append(chr(value))
+    return "".join(chars)
+
+class BinarySink(BufferedSink):
+    """
+    Writes log entries in a compact binary format to a file descriptor (see BINARY_MAGIC).
+    Strings like strategy names are only written once and referenced by their id afterwards.
+    """
+    _attrs_ = ["string_ids"]
+    
+    def __init__(self, fd, buffer_size=1 << 20):
+        BufferedSink.__init__(self, fd, buffer_size)
+        self.string_ids = {"": 0}
+        self.write(BINARY_MAGIC)
+    
+    def string_id(self, string):
+        if string in self.string_ids:
+            return self.string_ids[string]
+        id = len(self.string_ids)
+        self.string_ids[string] = id
+        self.write(encode_varint(TAG_STRING) + encode_varint(id) + encode_varint(len(string)) + string)
+        return id
+    
+    def write_entry(self, cause, old_strategy, new_strategy, typename, slots, objects, element_typenames, histogram):
+        record = [ encode_varint(TAG_ENTRY),
+                encode_varint(self.string_id(cause)),
+                encode_varint(self.string_id(old_strategy)),
+                encode_varint(self.string_id(new_strategy)),
+                encode_varint(self.string_id(typename)),
+                encode_varint(slots),
+                encode_varint(objects),
+                encode_varint(len(element_typenames)) ]
+        for element_typename in element_typenames:
+            record.append(encode_varint(self.string_id(element_typename)))
+        buckets = [ bucket for bucket in range(len(histogram)) if histogram[bucket] ]
+        record.append(encode_varint(len(buckets)))
+        for bucket in buckets:
+            record.append(encode_varint(bucket) + encode_varint(histogram[bucket]))
+        self.write("".join(record))
+    
+    def write_comment(self, comment):
+        self.write(encode_varint(TAG_COMMENT) + encode_varint(self.string_id(comment)))
 
 class LogEntry(object):
     def __init__(self):
         self.slots = 0
         self.objects = 0
         self.element_typenames = {}
+        self.histogram = []
         
-    def add(self, size, element_typename):
+    def add(self, size, element_typename, objects=1):
         self.slots += size
-        self.objects += 1
+        self.objects += objects
         if element_typename:
             self.element_typenames[element_typename] = None
+        # For multiple objects, only the average size is known.
+        bucket = size_bucket(size // objects if objects > 0 else size)
+        while len(self.histogram) <= bucket:
+            self.histogram.append(0)
+        self.histogram[bucket] += objects
     
     def classnames(self):
         return self.element_typenames.keys()
 
 class Logger(object):
-    _attrs_ = ["active", "aggregate", "logs"]
-    _immutable_fields_ = ["active?", "aggregate?", "logs"]
+    _attrs_ = ["active", "aggregate", "logs", "sink",
+                "sample_rate", "sample_collections", "always_log_size", "sample_counter", "counting", "strategy_names",
+                "counted_objects", "counted_slots", "converted_elements",
+                "timing", "timed_switches", "total_times", "max_times",
+                "profiling", "profile_classes", "profiled_calls", "profiled_elements", "class_profiles",
+                "slot_bytes", "generic_slot_bytes", "slot_bytes_written"]
+    _immutable_fields_ = ["active?", "aggregate?", "logs",
+                "sample_rate?", "sample_collections?", "always_log_size?", "counting?", "strategy_names[*]",
+                "counted_objects", "counted_slots",
+                "timing?", "timed_switches", "total_times", "max_times",
+                "profiling?", "profile_classes?", "profiled_calls", "profiled_elements", "class_profiles",
+                "slot_bytes[*]", "generic_slot_bytes"]
     
     def __init__(self):
         self.active = False
         self.aggregate = False
         self.logs = {}
+        self.sink = PrintSink()
+        self.sample_rate = 1
+        self.sample_collections = False
+        self.always_log_size = 0
+        self.sample_counter = 0
+        self.counting = False
+        self.timing = False
+        self.profiling = False
+        self.profile_classes = False
+        self.prepare_counters([])
+        self.set_slot_bytes([], 0)
     
-    def activate(self, aggregate=False):
+    def activate(self, aggregate=False, sample_rate=1, sample_collections=False, always_log_size=0):
+        """
+        With sample_rate > 1, only one of sample_rate events is logged, and its counts are
+        multiplied by sample_rate. If sample_collections is set, the logged events are selected by the
+        identity hash of the collection, so either all or none of the events of a collection are logged.
+        Otherwise, every sample_rate-th event is logged.
+        Events for collections with at least always_log_size elements are always logged (unless it is 0).
+        """
         self.active = True
         self.aggregate = self.aggregate or aggregate
+        self.sample_rate = sample_rate
+        self.sample_collections = sample_collections
+        self.always_log_size = always_log_size
+    
+    def sample_weight(self, size, collection_hash=0):
+        """
+        Return the number of events represented by an event with the given collection size,
+        or 0 if the event should not be logged.
+        """
+        if self.sample_rate <= 1:
+            return 1
+        if self.always_log_size > 0 and size >= self.always_log_size:
+            return 1
+        if self.sample_collections:
+            # Mix the bits of the hash, identity hashes are often aligned addresses.
+            mixed = (collection_hash * 0x9E3779B1) & 0xffffffff
+            selected = (mixed >> 16) % self.sample_rate == 0
+        else:
+            self.sample_counter += 1
+            selected = self.sample_counter >= self.sample_rate
+            if selected:
+                self.sample_counter = 0
+        return self.sample_rate if selected else 0
+    
+    def set_sink(self, sink):
+        """
+        Direct the output to the given LogSink. The default is a PrintSink.
+        """
+        self.sink.flush()
+        self.sink = sink
+    
+    def flush(self):
+        self.sink.flush()
+    
+    def activate_counters(self):
+        """
+        Only count the transitions between strategies, without formatting strings or allocating.
+        The counters can be printed with print_counters() or print_all().
+        """
+        self.counting = True
+    
+    def prepare_counters(self, strategy_names):
+        """
+        Allocate one counter per pair of strategies, plus one per strategy for created objects.
+        Counter index (old_id + 1) * n + new_id holds the transition from old_id to new_id.
+        old_id is -1 for created objects.
+        """
+        self.strategy_names = strategy_names
+        size = (len(strategy_names) + 1) * len(strategy_names)
+        self.counted_objects = [0] * size
+        self.counted_slots = [0] * size
+        self.converted_elements = 0
+        size = len(strategy_names) * len(strategy_names)
+        self.timed_switches = [0] * size
+        self.total_times = [0.0] * size
+        self.max_times = [0.0] * size
+        size = len(strategy_names) * len(PROFILE_OPERATIONS)
+        self.profiled_calls = [0] * size
+        self.profiled_elements = [0] * size
+        self.class_profiles = {}
+    
+    def activate_timing(self):
+        """
+        Measure the time spent converting the storage of collections when switching strategies,
+        aggregated per transition. The times are printed with print_timings() or print_all().
+        """
+        self.timing = True
+    
+    def set_slot_bytes(self, slot_bytes, generic_slot_bytes):
+        """
+        slot_bytes contains the estimated bytes per element for every strategy id, generic_slot_bytes
+        the bytes per element without strategies. They are written as comments before the first entry.
+        """
+        self.slot_bytes = slot_bytes
+        self.generic_slot_bytes = generic_slot_bytes
+        self.slot_bytes_written = False
+    
+    def print_slot_bytes(self):
+        self.slot_bytes_written = True
+        if not self.slot_bytes:
+            return
+        for strategy_id in range(len(self.slot_bytes)):
+            format = (self.strategy_names[strategy_id], self.slot_bytes[strategy_id])
+            self.sink.write_comment("slot-bytes (%s) %d" % format)
+        self.sink.write_comment("slot-bytes generic %d" % self.generic_slot_bytes)
     
-    def log(self, new_strategy, size, cause="", old_strategy="", typename="", element_typename=""):
+    def activate_profiling(self, profile_classes=False):
+        """
+        Count the calls to the element access methods of strategies (see PROFILE_OPERATIONS)
+        and the number of elements they touch, per strategy. If profile_classes is set, the counts are
+        also broken down by the class of the collection, which requires a dict lookup per call.
+        The counts are printed with print_profile() or print_all().
+        """
+        self.profiling = True
+        self.profile_classes = profile_classes
+        profiling_flag.active = True
+    
+    def profile(self, strategy_id, operation, elements, typename=""):
+        index = strategy_id * len(PROFILE_OPERATIONS) + operation
+        self.profiled_calls[index] += 1
+        self.profiled_elements[index] += elements
+        if typename:
+            key = (typename, index)
+            if key not in self.class_profiles:
+                self.class_profiles[key] = [0, 0]
+            counts = self.class_profiles[key]
+            counts[0] += 1
+            counts[1] += elements
+    
+    def timer(self):
+        return time.time()
+    
+    def time_switch(self, old_strategy_id, new_strategy_id, duration):
+        index = old_strategy_id * len(self.strategy_names) + new_strategy_id
+        self.timed_switches[index] += 1
+        self.total_times[index] += duration
+        if duration > self.max_times[index]:
+            self.max_times[index] = duration
+    
+    def count(self, old_strategy_id, new_strategy_id, size, objects=1):
+        index = (old_strategy_id + 1) * len(self.strategy_names) + new_strategy_id
+        self.counted_objects[index] += objects
+        self.counted_slots[index] += size
+        if old_strategy_id >= 0:
+            self.converted_elements += size
+    
+    def log(self, new_strategy, size, cause="", old_strategy="", typename="", element_typename="", objects=1, site=""):
+        """
+        typename is the class of the collection, site can optionally describe where it was allocated.
+        """
         if self.aggregate:
-            key = (cause, old_strategy, new_strategy, typename)
+            key = (cause, old_strategy, new_strategy, typename, site)
             if key not in self.logs:
                 self.logs[key] = LogEntry()
             entry = self.logs[key]
-            entry.add(size, element_typename)
+            entry.add(size, element_typename, objects)
         else:
             element_typenames = [ element_typename ] if element_typename else []
-            self.output(cause, old_strategy, new_strategy, typename, size, 1, element_typenames)
+            self.output(cause, old_strategy, new_strategy, typename_string(typename, site), size, objects, element_typenames, [])
+    
+    def print_all(self):
+        """
+        Print everything recorded by the activated modes: the aggregated log, the counters,
+        the conversion times and the access profile.
+        """
+        self.print_aggregated_log()
+        self.print_counters()
+        if not self.aggregate and not self.counting:
+            self.print_timings()
+            self.print_profile()
     
     def print_aggregated_log(self):
+        """
+        Print the aggregated entries, followed by the conversion times and the access profile,
+        unless the counters are active. print_counters() prints them in that case, so they appear once.
+        """
         if not self.aggregate:
             return
         for key, entry in self.logs.items():
-            cause, old_strategy, new_strategy, typename = key
+            cause, old_strategy, new_strategy, typename, site = key
             slots, objects, element_typenames = entry.slots, entry.objects, entry.classnames()
-            self.output(cause, old_strategy, new_strategy, typename, slots, objects, element_typenames)
+            self.output(cause, old_strategy, new_strategy, typename_string(typename, site), slots, objects, element_typenames, entry.histogram)
+        if not self.counting:
+            self.print_timings()
+            self.print_profile()
     
-    def output(self, cause, old_strategy, new_strategy, typename, slots, objects, element_typenames):
-        old_strategy_string = "%s -> " % old_strategy if old_strategy else ""
+    def print_counters(self):
+        """
+        Print the counted transitions, followed by the conversion times and the access profile.
+        """
+        if not self.counting:
+            return
+        n = len(self.strategy_names)
+        for index in range(len(self.counted_objects)):
+            objects = self.counted_objects[index]
+            if objects == 0:
+                continue
+            old_id, new_id = index // n - 1, index % n
+            if old_id < 0:
+                cause, old_strategy = "Created", ""
+            else:
+                cause, old_strategy = "Switched", self.strategy_names[old_id]
+            self.output(cause, old_strategy, self.strategy_names[new_id], "", self.counted_slots[index], objects, [], [])
+        self.sink.write_comment("converted elements %d" % self.converted_elements)
+        self.print_timings()
+        self.print_profile()
+    
+    def print_timings(self):
+        if not self.timing:
+            return
+        n = len(self.strategy_names)
+        for index in range(len(self.timed_switches)):
+            switches = self.timed_switches[index]
+            if switches == 0:
+                continue
+            old_strategy, new_strategy = self.strategy_names[index // n], self.strategy_names[index % n]
+            format = (old_strategy, new_strategy, switches, self.total_times[index], self.max_times[index])
+            self.sink.write_comment("time (%s -> %s) switches %d total %f max %f" % format)
+    
+    def print_profile(self):
+        if not self.profiling:
+            return
+        for index in range(len(self.profiled_calls)):
+            if self.profiled_calls[index] > 0:
+                self.output_profile(index, "", self.profiled_calls[index], self.profiled_elements[index])
+        for key, counts in self.class_profiles.items():
+            typename, index = key
+            self.output_profile(index, typename, counts[0], counts[1])
+    
+    def output_profile(self, index, typename, calls, elements):
+        strategy = self.strategy_names[index // len(PROFILE_OPERATIONS)]
+        operation = PROFILE_OPERATIONS[index % len(PROFILE_OPERATIONS)]
         classname_string = " of %s" % typename if typename else ""
-        element_string = (" elements: " + " ".join(element_typenames)) if element_typenames else ""
-        format = (cause, old_strategy_string, new_strategy, classname_string, slots, objects, element_string)
-        print "%s (%s%s)%s size %d objects %d%s" % format
+        format = (strategy, classname_string, operation, calls, elements)
+        self.sink.write_comment("profile (%s)%s %s calls %d elements %d" % format)
+    
+    def output(self, cause, old_strategy, new_strategy, typename, slots, objects, element_typenames, histogram):
+        if not self.slot_bytes_written:
+            self.print_slot_bytes()
+        self.sink.write_entry(cause, old_strategy, new_strategy, typename, slots, objects, element_typenames, histogram)
@@ -1,5 +1,6 @@
 
-import re, os, sys, operator
+import re, os, sys, operator, mmap, subprocess, time, io, json, marshal
+from rstrategies_logger import BINARY_MAGIC, TAG_STRING, TAG_ENTRY, TAG_COMMENT
 
 """
 This script parses a log produced by rstrategies_logger.py into a graph and converts it to various outputs.
@@ -9,6 +10,14 @@ at some point during the log.
 Artificial nodes are created for log entries without an explicit source node. These are the events when a
 collection is created.
 The input to this script is a logfile, a command and optional flags.
+The logfile can be in the text format or in the binary format of rstrategies_logger.BinarySink.
+Logs compressed with gzip, bzip2 or xz (ending with .gz, .bz2 or .xz) are decompressed while parsing.
+The parsed graph is cached in a file next to the logfile (see cache_file), which is reused
+as long as the logfile does not change. Use -C to ignore and not write the cache.
+Loading the cache does not execute code (see load_cache), but a cache file written by
+someone else should still be treated like any other untrusted input.
+With -f, the summarize and dot commands follow a growing logfile and output the current graph
+every few seconds (-i), like tail -f.
 If the logfile includes one of the AVAILABLE_VMS as a substring, the following three global variables
 are automatically configured.
 The script should work without these configurations, but the output will probably not be that pretty.
@@ -54,35 +63,298 @@ def percent(part, total):
         return 0
     return float(part)*100 / total
 
-def parse(filename, flags, callback):
+def parse(filename, flags, callback, comment_callback=None):
+    """
+    Call callback with every LogEntry in the logfile, and comment_callback (if given)
+    with the text of every comment, like the slot-bytes comments written by the logger.
+    """
+    with open_log(filename) as file:
+        return parse_file(file, flags, callback, comment_callback)
+
+def parse_file(file, flags, callback, comment_callback=None):
     parsed_entries = 0
-    if filename == "-":
-        opener = lambda: sys.stdin
+    header = file.read(len(BINARY_MAGIC))
+    if header == BINARY_MAGIC:
+        entries = parse_binary(file, flags)
     else:
-        opener = lambda: open(filename, 'r', 1)
-    with opener() as file:
-        while True:
-            line = file.readline()
-            if len(line) == 0:
-                break
-            entry = parse_line(line, flags)
-            if entry:
-                parsed_entries += 1
-                callback(entry)
+        entries = parse_text(file, header, flags)
+    for entry in entries:
+        if isinstance(entry, str):
+            if comment_callback:
+                comment_callback(entry)
+        else:
+            parsed_entries += 1
+            callback(entry)
     return parsed_entries
 
-line_pattern = re.compile("^(?P<operation>\w+) \(((?P<old>\w+) -> )?(?P<new>\w+)\)( of (?P<classname>.+))? size (?P<size>[0-9]+)( objects (?P<objects>[0-9]+))?( elements: (?P<classnames>.+( .+)*))?$")
+def open_log(filename):
+    """
+    Open the logfile for reading with read(), decompressing it on the fly if its name has
+    one of the COMPRESSED_SUFFIXES. Plain files are memory-mapped.
+    """
+    if filename == "-":
+        return sys.stdin
+    if filename.endswith(".gz"):
+        import gzip
+        return gzip.GzipFile(filename, 'rb')
+    if filename.endswith(".bz2"):
+        import bz2
+        return bz2.BZ2File(filename, 'rb')
+    if filename.endswith(".xz"):
+        lzma = import_lzma()
+        if lzma is None:
+            return PipeFile(["xz", "--decompress", "--stdout", filename])
+        return lzma.LZMAFile(filename, 'rb')
+    return MappedFile(filename)
+
+COMPRESSED_SUFFIXES = [".gz", ".bz2", ".xz"]
+
+def is_compressed(filename):
+    return any(filename.endswith(suffix) for suffix in COMPRESSED_SUFFIXES)
+
+def import_lzma():
+    # lzma is only part of the standard library from Python 3.3, Python 2 needs the backports.lzma package.
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            return None
+    return lzma
+
+class MappedFile(object):
+    """
+    Read-only file backed by a memory mapping, avoiding copies through the read buffers of file objects.
+    """
+    
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        if os.fstat(self.file.fileno()).st_size == 0:
+            # Empty files cannot be mapped.
+            self.data = self.file
+        else:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    def read(self, size):
+        return self.data.read(size)
+    
+    def seek(self, position):
+        self.data.seek(position)
+    
+    def close(self):
+        self.data.close()
+        self.file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+
+class PipeFile(object):
+    """
+    Read the output of a decompressing command, for formats without a python module.
+    """
+    
+    def __init__(self, command):
+        self.command = command
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    
+    def read(self, size):
+        return self.process.stdout.read(size)
+    
+    def close(self):
+        self.process.stdout.close()
+        if self.process.wait() not in (0, -13): # Killed by SIGPIPE when closed early.
+            raise Exception("Decompressing failed: %s" % " ".join(self.command))
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+
+# The parse_* generators yield LogEntries and comment strings.
+
+BLOCK_SIZE = 1 << 20
+
+def read_lines(file, header):
+    """
+    Yield the lines of file without line endings, reading large blocks at once.
+    The header was already consumed while detecting the format and belongs to the first line.
+    """
+    pending = header
+    while True:
+        block = file.read(BLOCK_SIZE)
+        if len(block) == 0:
+            break
+        lines = (pending + block).split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+def parse_text(file, header, flags):
+    for line in read_lines(file, header):
+        if line.startswith("# "):
+            yield line[2:].rstrip("\r")
+            continue
+        entry = parse_line(line, flags)
+        if entry:
+            yield entry
+
+class BinaryReader(object):
+    
+    def __init__(self, file, chunk_size=1 << 16):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.data = ""
+        self.pos = 0
+    
+    def at_end(self):
+        if self.pos < len(self.data):
+            return False
+        self.data = self.file.read(self.chunk_size)
+        self.pos = 0
+        return len(self.data) == 0
+    
+    def read(self, size):
+        result = self.data[self.pos:self.pos + size]
+        self.pos += len(result)
+        while len(result) < size:
+            if self.at_end():
+                raise Exception("Unexpected end of binary log")
+            chunk = self.data[self.pos:self.pos + size - len(result)]
+            self.pos += len(chunk)
+            result += chunk
+        return result
+    
+    def varint(self):
+        result = 0
+        shift = 0
+        while True:
+            if self.at_end():
+                raise Exception("Unexpected end of binary log")
+            byte = ord(self.data[self.pos])
+            self.pos += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+def parse_binary(file, flags):
+    reader = BinaryReader(file)
+    strings = { 0: "" }
+    while not reader.at_end():
+        tag = reader.varint()
+        if tag == TAG_STRING:
+            id = reader.varint()
+            strings[id] = reader.read(reader.varint())
+        elif tag == TAG_ENTRY:
+            operation, old_storage, new_storage, classname = [ strings[reader.varint()] for i in range(4) ]
+            size = reader.varint()
+            objects = reader.varint()
+            classnames = set([ strings[reader.varint()] for i in range(reader.varint()) ])
+            histogram = dict([ (reader.varint(), reader.varint()) for i in range(reader.varint()) ]) or None
+            yield make_entry(operation, old_storage or None, new_storage, classname or None, size, objects, classnames, histogram, flags)
+        elif tag == TAG_COMMENT:
+            yield strings[reader.varint()]
+        else:
+            raise Exception("Unknown record tag %d in binary log" % tag)
+
+line_pattern = re.compile("^(?P<operation>\w+) \(((?P<old>\w+) -> )?(?P<new>\w+)\)( of (?P<classname>.+))? size (?P<size>[0-9]+)( objects (?P<objects>[0-9]+))?( histogram (?P<histogram>[0-9:,]+))?( elements: (?P<classnames>.+( .+)*))?$")
+
+# Parsed sets of element classnames, shared between entries.
+classnames_cache = {}
+
+def parse_classnames(classnames):
+    if classnames not in classnames_cache:
+        classnames_cache[classnames] = set(intern(x) for x in classnames.split(' '))
+    return classnames_cache[classnames]
+
+def parse_histogram(histogram):
+    return dict([ int(x) for x in bucket.split(':') ] for bucket in histogram.split(','))
 
 def parse_line(line, flags):
+    entry = parse_line_fast(line, flags)
+    if entry is None:
+        entry = parse_line_regex(line, flags)
+    return entry
+
+def parse_line_fast(line, flags):
+    """
+    Parse a line in the format written by rstrategies_logger without a regex:
+    operation (old -> new) of classname size 0 objects 0 histogram 0:0 elements: a b
+    The old strategy and all parts after the size are optional. Return None if the line
+    does not have this format, so the regex can handle it.
+    """
+    prefix, separator, rest = line.rstrip("\r").partition(" size ")
+    names = prefix_cache.get(prefix)
+    if names is None:
+        if not separator:
+            return None
+        names = parse_prefix(prefix, flags)
+        if names is None:
+            return None
+        prefix_cache[prefix] = names
+    rest, separator, classnames = rest.partition(" elements: ")
+    classnames = parse_classnames(classnames) if classnames else set()
+    tokens = rest.split(" ")
+    objects = 1
+    histogram = None
+    try:
+        size = int(tokens[0])
+        for i in range(1, len(tokens), 2):
+            key = tokens[i]
+            if key == "objects":
+                objects = int(tokens[i + 1])
+            elif key == "histogram":
+                histogram = parse_histogram(tokens[i + 1])
+            else:
+                return None
+    except (ValueError, IndexError):
+        return None
+    operation, old_storage, new_storage, classname, is_storage_source = names
+    return LogEntry(operation, old_storage, new_storage, classname, size, objects, classnames, is_storage_source, histogram)
+
+# Maps the part of log lines before the size to the resolved names in it (see parse_prefix).
+prefix_cache = {}
+
+def parse_prefix(prefix, flags):
+    # Parse "operation (old -> new) of classname", where the old strategy and the classname are optional.
+    tokens = prefix.split(" ")
+    if len(tokens) < 2 or tokens[1][0] != "(":
+        return None
+    if tokens[1][-1] == ")":
+        old_storage = None
+        new_storage = tokens[1][1:-1]
+        i = 2
+    elif len(tokens) >= 4 and tokens[2] == "->" and tokens[3][-1] == ")":
+        old_storage = tokens[1][1:]
+        new_storage = tokens[3][:-1]
+        i = 4
+    else:
+        return None
+    if i == len(tokens):
+        classname = None
+    elif tokens[i] == "of" and i + 1 < len(tokens):
+        classname = " ".join(tokens[i + 1:])
+    else:
+        return None
+    return resolve_names(tokens[0], old_storage, new_storage, classname, flags)
+
+def parse_line_regex(line, flags):
     result = line_pattern.match(line)
     if result is None:
-        if flags.verbose:
-            print "Could not parse line: %s" % line[:-1]
+        if flags.verbose and not line.startswith("#"):
+            print "Could not parse line: %s" % line
         return None
     operation = str(result.group('operation'))
     old_storage = result.group('old')
     new_storage = str(result.group('new'))
-    classname = str(result.group('classname'))
+    classname = result.group('classname')
     size = int(result.group('size'))
     objects = result.group('objects')
     objects = int(objects) if objects else 1
@@ -92,13 +364,39 @@ def parse_line(line, flags):
         classnames = set(classnames)
     else:
         classnames = set()
-    
+    histogram = result.group('histogram')
+    if histogram is not None:
+        histogram = parse_histogram(histogram)
+    return make_entry(operation, old_storage, new_storage, classname, size, objects, classnames, histogram, flags)
+
+printed_warnings = set()
+
+def warn_once(message):
+    if message not in printed_warnings:
+        printed_warnings.add(message)
+        print message
+
+def make_entry(operation, old_storage, new_storage, classname, size, objects, classnames, histogram, flags):
+    operation, old_storage, new_storage, classname, is_storage_source = \
+        resolve_names(operation, old_storage, new_storage, classname, flags)
+    return LogEntry(operation, old_storage, new_storage, classname, size, objects, classnames, is_storage_source, histogram)
+
+def resolve_names(operation, old_storage, new_storage, classname, flags):
+    """
+    Apply the VM configuration and flags to the names in a log entry.
+    Return the interned (operation, old_storage, new_storage, classname, is_storage_source).
+    """
+    if classname is not None and not flags.sites:
+        # Collection classes can be followed by their allocation site: "<classname> at <site>".
+        classname = classname.split(" at ", 1)[0]
+    classname = str(classname)
     is_storage_source = old_storage is None
     if is_storage_source:
         if operation in STORAGE_SOURCES:
             old_storage = STORAGE_SOURCES[operation]
         else:
-            print "Using operation %s as storage source." % operation
+            warn_once("Using operation %s as storage source." % operation)
+            old_storage = operation
     old_storage = str(old_storage)
     
     if new_storage in NODE_RENAMINGS:
@@ -106,11 +404,41 @@ def parse_line(line, flags):
     if old_storage in NODE_RENAMINGS:
         old_storage = NODE_RENAMINGS[old_storage]
     
-    return LogEntry(operation, old_storage, new_storage, classname, size, objects, classnames, is_storage_source)
+    return intern(operation), intern(old_storage), intern(new_storage), intern(classname), is_storage_source
+
+def histogram_string(histogram):
+    return ",".join([ "%d:%d" % item for item in sorted(histogram.items()) if item[1] ])
+
+def merge_histograms(histogram1, histogram2, factor=1):
+    result = dict(histogram1)
+    for bucket, objects in histogram2.items():
+        result[bucket] = result.get(bucket, 0) + factor * objects
+    return result
+
+def bucket_limit(bucket):
+    "The largest size in the given size bucket (see rstrategies_logger.size_bucket)."
+    return (1 << bucket) - 1
+
+def histogram_percentiles(histogram, percentiles):
+    """
+    Return the upper size limits of the buckets containing the given percentiles (0-100) of objects.
+    Negative counts, which can result from subtracting histograms, are ignored.
+    """
+    buckets = [ (bucket, objects) for bucket, objects in sorted(histogram.items()) if objects > 0 ]
+    total = sum(objects for bucket, objects in buckets)
+    result = []
+    for p in percentiles:
+        seen = 0
+        for bucket, objects in buckets:
+            seen += objects
+            if seen * 100 >= p * total:
+                result.append(bucket_limit(bucket))
+                break
+    return result
 
 class LogEntry(object):
     
-    def __init__(self, operation, old_storage, new_storage, classname, size, objects, classnames, is_storage_source):
+    def __init__(self, operation, old_storage, new_storage, classname, size, objects, classnames, is_storage_source, histogram=None):
         self.operation = operation
         self.old_storage = old_storage
         self.new_storage = new_storage
@@ -119,6 +447,10 @@ class LogEntry(object):
         self.objects = objects
         self.classnames = classnames
         self.is_storage_source = is_storage_source
+        if histogram is None:
+            # Only the average size is known. bit_length() is equivalent to size_bucket().
+            histogram = { (size // objects if objects > 0 else size).bit_length(): objects }
+        self.histogram = histogram
         assert old_storage != new_storage, "old and new storage identical in log entry: %s" % self
     
     def full_key(self):
@@ -134,7 +466,8 @@ class LogEntry(object):
         old_storage_string = "%s -> " % self.old_storage if self.old_storage else ""
         classname_string = " of %s" % self.classname if self.classname else ""
         objects_string = " objects %d" % self.objects if self.objects > 1 else ""
-        return "%s (%s%s)%s size %d%s" % (self.operation, old_storage_string, self.new_storage, classname_string, self.size, objects_string)
+        histogram_string_ = " histogram %s" % histogram_string(self.histogram) if len(self.histogram) > 1 else ""
+        return "%s (%s%s)%s size %d%s%s" % (self.operation, old_storage_string, self.new_storage, classname_string, self.size, objects_string, histogram_string_)
 
 # ====================================================================
 # ======== Graph parsing
@@ -142,10 +475,11 @@ class LogEntry(object):
 
 class Operations(object):
     
-    def __init__(self, objects=0, slots=0, element_classnames=[]):
+    def __init__(self, objects=0, slots=0, element_classnames=[], histogram={}):
         self.objects = objects
         self.slots = slots
         self.element_classnames = set(element_classnames)
+        self.histogram = dict(histogram)
     
     def __str__(self, total=None):
         if self.objects == 0:
@@ -170,15 +504,34 @@ class Operations(object):
         return "%s(%s)" % (self.__str__(), object.__repr__(self))
     
     def add_log_entry(self, entry):
-        self.slots = self.slots + entry.size
-        self.objects = self.objects + entry.objects
-        self.element_classnames |= entry.classnames
+        self.add_counts(entry.objects, entry.size, entry.classnames, entry.histogram)
+    
+    def add(self, other):
+        # In-place version of __add__
+        self.add_counts(other.objects, other.slots, other.element_classnames, other.histogram)
+    
+    def add_counts(self, objects, slots, element_classnames, histogram):
+        self.objects += objects
+        self.slots += slots
+        self.element_classnames.update(element_classnames)
+        own_histogram = self.histogram
+        for bucket, bucket_objects in histogram.iteritems():
+            own_histogram[bucket] = own_histogram.get(bucket, 0) + bucket_objects
     
     def __sub__(self, other):
-        return Operations(self.objects - other.objects, self.slots - other.slots)
+        return Operations(self.objects - other.objects, self.slots - other.slots, self.element_classnames,
+                            histogram=merge_histograms(self.histogram, other.histogram, -1))
     
     def __add__(self, other):
-        return Operations(self.objects + other.objects, self.slots + other.slots)
+        return Operations(self.objects + other.objects, self.slots + other.slots,
+                            self.element_classnames | other.element_classnames,
+                            histogram=merge_histograms(self.histogram, other.histogram))
+    
+    def percentiles_string(self):
+        limits = histogram_percentiles(self.histogram, [50, 90, 99, 100])
+        if not limits:
+            return ""
+        return "sizes: p50 <= %d, p90 <= %d, p99 <= %d, max <= %d" % tuple(limits)
     
     def __lt__(self, other):
         return self.slots < other.slots
@@ -201,7 +554,11 @@ class ClassOperations(object):
         return self.classes[name]
     
     def total(self):
-        return reduce(operator.add, self.classes.values(), Operations())
+        # Element classnames are only printed per class (-c), so the sum does not collect them.
+        result = Operations()
+        for ops in self.classes.itervalues():
+            result.add_counts(ops.objects, ops.slots, (), ops.histogram)
+        return result
     
     def __str__(self):
         return "ClassOperations(%s)" % self.classes
@@ -209,6 +566,11 @@ class ClassOperations(object):
     def __repr__(self):
         return "%s(%s)" % (self.__str__(), object.__repr__(self))
     
+    def add(self, other):
+        # In-place version of __add__
+        for classname, other_class in other.classes.iteritems():
+            self.cls(classname).add(other_class)
+    
     def __add__(self, other):
         result = ClassOperations()
         result.classes = dict(self.classes)
@@ -233,6 +595,9 @@ class StorageEdge(object):
         self.origin = origin
         self.target = target
         self.is_storage_source = False
+        # Incremented on every change, to re-render only changed edges in follow mode.
+        self.version = 0
+        self.cached_total = None
     
     def full_key(self):
         return (self.operation, self.origin.name, self.target.name)
@@ -241,13 +606,23 @@ class StorageEdge(object):
         return self.classes.cls(classname)
     
     def total(self):
-        return self.classes.total()
+        if self.cached_total is None:
+            self.cached_total = self.classes.total()
+        return self.cached_total
     
     def notify_nodes(self):
         self.origin.note_outgoing(self)
         self.target.note_incoming(self)
     
+    def changed(self):
+        # Must be called after modifying the classes of an edge in the graph, to invalidate cached totals.
+        self.version += 1
+        self.cached_total = None
+        self.origin.changed()
+        self.target.changed()
+    
     def add_log_entry(self, entry):
+        self.changed()
         self.cls(entry.classname).add_log_entry(entry)
         if entry.is_storage_source:
             self.is_storage_source = True
@@ -257,7 +632,7 @@ class StorageEdge(object):
         for classname, ops in self.classes.classes.items():
             origin = None if self.is_storage_source else self.origin.name
             entry = LogEntry(self.operation, origin, self.target.name, classname,
-                            ops.slots, ops.objects, ops.element_classnames, self.is_storage_source)
+                            ops.slots, ops.objects, ops.element_classnames, self.is_storage_source, ops.histogram)
             entries.append(entry)
         return entries
     
@@ -284,40 +659,83 @@ class StorageEdge(object):
         result.classes += self.classes - other.classes
         return result
     
+def sum_edges(edges, operation="None"):
+    # Same as reduce(operator.add, edges, StorageEdge(operation)), without copying the intermediate sums.
+    result = StorageEdge(operation)
+    for edge in edges:
+        if result.origin is None:
+            result.origin = edge.origin
+        if result.target is None:
+            result.target = edge.target
+        result.classes.add(edge.classes)
+    return result
+
 class StorageNode(object):
     
     def __init__(self, name):
         self.name = name
         self.incoming = set()
         self.outgoing = set()
+        # Edges by operation
+        self.incoming_index = {}
+        self.outgoing_index = {}
+        # Sums of incoming and outgoing edges, cleared when an edge changes.
+        self.sums = {}
     
     def note_incoming(self, edge):
         assert edge.target is self
         if edge not in self.incoming:
             self.incoming.add(edge)
+            self.incoming_index.setdefault(edge.operation, []).append(edge)
+            self.changed()
         
     def note_outgoing(self, edge):
         assert edge.origin is self
         if edge not in self.outgoing:
             self.outgoing.add(edge)
-        
+            self.outgoing_index.setdefault(edge.operation, []).append(edge)
+            self.changed()
+    
+    def forget_edge(self, edge):
+        if edge in self.incoming:
+            self.incoming.remove(edge)
+            self.incoming_index[edge.operation].remove(edge)
+        if edge in self.outgoing:
+            self.outgoing.remove(edge)
+            self.outgoing_index[edge.operation].remove(edge)
+        self.changed()
+    
+    def changed(self):
+        self.sums.clear()
+    
     def incoming_edges(self, operation):
-        return filter(lambda x: x.operation == operation, self.incoming)
+        return self.incoming_index.get(operation, [])
     
     def outgoing_edges(self, operation):
-        return filter(lambda x: x.operation == operation, self.outgoing)
+        return self.outgoing_index.get(operation, [])
+    
+    def cached_sum(self, key, edges, operation="None"):
+        if key not in self.sums:
+            self.sums[key] = sum_edges(edges, operation)
+        return self.sums[key]
     
     def sum_incoming(self, operation):
-        return reduce(operator.add, self.incoming_edges(operation), StorageEdge(operation))
+        return self.cached_sum(("incoming", operation), self.incoming_edges(operation), operation)
         
     def sum_outgoing(self, operation):
-        return reduce(operator.add, self.outgoing_edges(operation), StorageEdge(operation))
+        return self.cached_sum(("outgoing", operation), self.outgoing_edges(operation), operation)
+    
+    # The sums of all edges add up the (usually few) sums per operation, not every single edge.
     
     def sum_all_incoming(self):
-        return reduce(operator.add, self.incoming, StorageEdge())
+        return self.cached_sum("incoming", [ self.sum_incoming(operation) for operation in self.incoming_index ])
     
     def sum_all_outgoing(self):
-        return reduce(operator.add, self.outgoing, StorageEdge())
+        return self.cached_sum("outgoing", [ self.sum_outgoing(operation) for operation in self.outgoing_index ])
+    
+    def version(self):
+        # Changes whenever one of the edges of this node changes.
+        return sum(edge.version for edge in self.incoming) + sum(edge.version for edge in self.outgoing)
     
     def __str__(self):
         return self.name
@@ -325,28 +743,6 @@ class StorageNode(object):
     def __repr__(self):
         return "%s(%s)" % (self.__str__(), object.__repr__(self))
     
-    def merge_edge_sets(self, set1, set2, key_slot):
-        getter = lambda edge: edge.__dict__[key_slot]
-        set_dict = dict([(getter(edge), edge) for edge in set1])
-        for edge in set2:
-            key = getter(edge)
-            if key not in set_dict:
-                set_dict[key] = edge
-            else:
-                set_dict[key] += edge
-        return set(set_dict.values())
-    
-    def __add__(self, other):
-        result = StorageNode("%s %s" % (self.name, other.name))
-        result.incoming = self.merge_edge_sets(self.incoming, other.incoming, "origin")
-        # TODO bad code
-        for edge in result.incoming:
-            edge.target = result
-        result.outgoing = self.merge_edge_sets(self.outgoing, other.outgoing, "target")
-        for edge in result.outgoing:
-            edge.origin = result
-        return result
-    
     def __lt__(self, other):
         return self.name < other.name
     
@@ -368,6 +764,8 @@ class StorageGraph(object):
         self.nodes = {}
         self.edges = {}
         self.operations = set()
+        # Check the consistency of the graph after changing its structure.
+        self.debug = False
     
     def node(self, name):
         if str(name) == 'None':
@@ -377,10 +775,16 @@ class StorageGraph(object):
         return self.nodes[name]
     
     def assert_sanity(self):
+        edges = set(self.edges.values())
+        assert len(edges) == len(self.edges), "Edge registered under multiple keys."
+        for key, edge in self.edges.items():
+            assert key == edge.full_key(), "Edge registered under wrong key %s: %s" % (key, edge)
+            assert self.nodes.get(edge.origin.name) is edge.origin, "Edge origin not in graph's nodes: %s" % edge
+            assert self.nodes.get(edge.target.name) is edge.target, "Edge target not in graph's nodes: %s" % edge
         visited_edges = set()
         for node in self.nodes.values():
             for edge in node.incoming:
-                assert edge in self.edges.values(), "Edge not in graph's edges: %s" % edge
+                assert edge in edges, "Edge not in graph's edges: %s" % edge
                 visited_edges.add(edge)
                 if not edge.target is node:
                     print "Wrong edge target: %s\nIncoming edge: %s\nIn node: %s" % (edge.target, edge, node)
@@ -389,7 +793,7 @@ class StorageGraph(object):
                     print "Edge not in origin's outgoing: %s\nIncoming edge: %s\nIn node: %s" % (edge.origin.outgoing, edge, node)
                     assert False
             for edge in node.outgoing:
-                assert edge in self.edges.values(), "Edge not in graph's edges: %s" % edge
+                assert edge in edges, "Edge not in graph's edges: %s" % edge
                 visited_edges.add(edge)
                 if not edge.origin is node:
                     print "Wrong edge origin: %s\nOutgoing edge: %s\nIn node: %s" % (edge.origin, edge, node)
@@ -397,7 +801,12 @@ class StorageGraph(object):
                 if not edge in edge.target.incoming:
                     print "Edge not in origin's incoming: %s\nOutgoing edge: %s\nIn node: %s" % (edge.target.incoming, edge, node)
                     assert False
-        assert len(visited_edges) == len(self.edges.values()), "Not all of graph's edges visited."
+            for edge_set, index in ((node.incoming, node.incoming_index), (node.outgoing, node.outgoing_index)):
+                assert sum(len(indexed) for indexed in index.values()) == len(edge_set), "Index out of date in node: %s" % node
+                for operation, indexed in index.items():
+                    for edge in indexed:
+                        assert edge in edge_set and edge.operation == operation, "Wrong indexed edge: %s\nIn node: %s" % (edge, node)
+        assert len(visited_edges) == len(self.edges), "Not all of graph's edges visited."
     
     def add_log_entry(self, log_entry):
         self.operations.add(log_entry.operation)
@@ -408,36 +817,55 @@ class StorageGraph(object):
             edge.notify_nodes()
         self.edges[key].add_log_entry(log_entry)
     
+    def merge_edges(self, edges):
+        # Add edges aggregated elsewhere, as returned by graph_edges.
+        for key, is_storage_source, classes in edges:
+            operation, origin, target = key
+            self.operations.add(operation)
+            if key not in self.edges:
+                edge = StorageEdge(operation, self.node(origin), self.node(target))
+                self.edges[key] = edge
+                edge.notify_nodes()
+            edge = self.edges[key]
+            for classname, objects, slots, element_classnames, histogram in classes:
+                edge.cls(classname).add_counts(objects, slots, element_classnames, histogram)
+            edge.changed()
+            if is_storage_source:
+                edge.is_storage_source = True
+    
     def collapse_nodes(self, collapsed_nodes, new_name=None):
+        """
+        Replace the nodes with one node, merging their edges with equal operations and neighbours.
+        Edges between the collapsed nodes become edges from the new node to itself.
+        """
         if len(collapsed_nodes) == 0:
             return
+        if new_name is None:
+            new_name = " ".join([ node.name for node in collapsed_nodes ])
+        names = set([ node.name for node in collapsed_nodes ])
+        collapsed_edges = set()
         for node in collapsed_nodes:
             del self.nodes[node.name]
-            for edge in node.incoming:
-                del self.edges[edge.full_key()]
-            for edge in node.outgoing:
-                del self.edges[edge.full_key()]
-        new_node = reduce(operator.add, collapsed_nodes)
-        if new_name is not None:
-            new_node.name = new_name
-        self.nodes[new_node.name] = new_node
-        # TODO bad code
-        for node in collapsed_nodes:
-            for edge in node.incoming:
-                edge.origin.outgoing.remove(edge)
-                new_edges = filter(lambda filtered: filtered.origin == edge.origin, new_node.incoming)
-                assert len(new_edges) == 1
-                edge.origin.outgoing.add(new_edges[0])
-            for edge in node.outgoing:
-                edge.target.incoming.remove(edge)
-                new_edges = filter(lambda filtered: filtered.target == edge.target, new_node.outgoing)
-                assert len(new_edges) == 1
-                edge.target.incoming.add(new_edges[0])
-        for edge in new_node.incoming:
-            self.edges[edge.full_key()] = edge
-        for edge in new_node.outgoing:
-            self.edges[edge.full_key()] = edge
-        self.assert_sanity()
+            collapsed_edges |= node.incoming
+            collapsed_edges |= node.outgoing
+        new_node = self.node(new_name)
+        for edge in collapsed_edges:
+            del self.edges[edge.full_key()]
+            edge.origin.forget_edge(edge)
+            edge.target.forget_edge(edge)
+            origin = new_node if edge.origin.name in names else edge.origin
+            target = new_node if edge.target.name in names else edge.target
+            key = (edge.operation, origin.name, target.name)
+            if key not in self.edges:
+                new_edge = StorageEdge(edge.operation, origin, target)
+                self.edges[key] = new_edge
+                new_edge.notify_nodes()
+            new_edge = self.edges[key]
+            new_edge.classes.add(edge.classes)
+            new_edge.is_storage_source = new_edge.is_storage_source or edge.is_storage_source
+            new_edge.changed()
+        if self.debug:
+            self.assert_sanity()
     
     def collapse_nonstorage_nodes(self, new_name=None):
         nodes = filter(lambda x: not x.is_storage_node(), self.nodes.values())
@@ -448,19 +876,278 @@ class StorageGraph(object):
         nodes.sort()
         return nodes
     
-def make_graph(logfile, flags):
+def make_graph(logfile, flags, comment_callback=None):
+    key = cache_key(logfile, flags)
+    cached = load_cache(logfile, key, flags)
+    if cached is None:
+        comments = []
+        if flags.jobs > 1 and can_shard(logfile):
+            graph = make_graph_sharded(logfile, flags, comments.append)
+        else:
+            graph = StorageGraph()
+            def callback(entry):
+                graph.add_log_entry(entry)
+            parse(logfile, flags, callback, comments.append)
+        save_cache(logfile, key, (graph_edges(graph), comments), flags)
+    else:
+        edges, comments = cached
+        graph = StorageGraph()
+        graph.merge_edges(edges)
+    if comment_callback:
+        for comment in comments:
+            comment_callback(comment)
+    graph.debug = flags.debug
+    if graph.debug:
+        graph.assert_sanity()
+    return graph
+
+def graph_edges(graph):
+    """
+    Return the aggregated edges of the graph as plain tuples, which are serialized much faster than the graph itself:
+    (key, is_storage_source, [ (classname, objects, slots, element_classnames, histogram), ... ])
+    """
+    return [ (key, edge.is_storage_source,
+                [ (classname, ops.objects, ops.slots, list(ops.element_classnames), ops.histogram)
+                    for classname, ops in edge.classes.classes.iteritems() ])
+            for key, edge in graph.edges.iteritems() ]
+
+# ====================================================================
+# ======== Graph cache
+# ====================================================================
+
+# Increment when the format of the cached data changes.
+CACHE_VERSION = 3
+
+def cache_file(logfile):
+    return logfile + ".cache"
+
+def cache_key(logfile, flags):
+    """
+    Identify the parsed logfile by its path, size and modification time, and the settings
+    that change the parsed names. Return None if the graph of the logfile should not be cached.
+    """
+    if flags.nocache or logfile == "-" or not os.path.isfile(logfile):
+        return None
+    stat = os.stat(logfile)
+    return (CACHE_VERSION, os.path.abspath(logfile), stat.st_size, stat.st_mtime, flags.sites,
+            STORAGE_NODES, sorted(NODE_RENAMINGS.items()), sorted(STORAGE_SOURCES.items()))
+
+def cache_header(key):
+    # The key is stored as a line of JSON, which load_cache compares as a string.
+    return "rstrategies-cache %s\n" % json.dumps(key)
+
+def load_cache(logfile, key, flags):
+    """
+    Return the data cached for the key, or None. The first line of the cache file must
+    match the key exactly, so caches of other logfiles or versions are rejected without
+    reading any further. The data is stored with marshal, which can only represent plain
+    values (no instances of classes) and does not execute code when loading.
+    """
+    if key is None or not os.path.isfile(cache_file(logfile)):
+        return None
+    header = cache_header(key)
+    try:
+        with open(cache_file(logfile), 'rb') as file:
+            if file.readline(len(header) + 1) != header:
+                return None
+            data = marshal.load(file)
+    except Exception, e:
+        if flags.verbose:
+            print "Could not load cache %s: %s" % (cache_file(logfile), e)
+        return None
+    if flags.verbose:
+        print "Using cache %s" % cache_file(logfile)
+    return data
+
+def save_cache(logfile, key, data, flags):
+    if key is None:
+        return
+    # Write a temporary file first, so concurrent commands never load a partial cache.
+    filename = cache_file(logfile)
+    tmp_filename = "%s.%d" % (filename, os.getpid())
+    try:
+        with open(tmp_filename, 'wb') as file:
+            file.write(cache_header(key))
+            marshal.dump(data, file)
+        os.rename(tmp_filename, filename)
+    except (IOError, OSError), e:
+        if flags.verbose:
+            print "Could not write cache %s: %s" % (filename, e)
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+# ====================================================================
+# ======== Parallel parsing
+# ====================================================================
+
+def can_shard(logfile):
+    # Binary logs define their strings on the fly, so they can only be read sequentially.
+    # Compressed logs can only be read sequentially as well.
+    if logfile == "-" or is_compressed(logfile) or not os.path.isfile(logfile):
+        return False
+    with open(logfile, 'rb') as file:
+        return file.read(len(BINARY_MAGIC)) != BINARY_MAGIC
+
+def shard_boundaries(logfile, shards):
+    """
+    Split the logfile into at most the given number of byte ranges, starting each range at a line boundary.
+    """
+    size = os.path.getsize(logfile)
+    boundaries = [0]
+    with open(logfile, 'rb') as file:
+        for i in range(1, shards):
+            file.seek(size * i // shards)
+            file.readline()
+            position = min(file.tell(), size)
+            if position > boundaries[-1]:
+                boundaries.append(position)
+    if size > boundaries[-1]:
+        boundaries.append(size)
+    return zip(boundaries[:-1], boundaries[1:])
+
+class FileRange(object):
+    """
+    File-like object reading only the bytes between start and end of a file.
+    """
+    
+    def __init__(self, file, start, end):
+        file.seek(start)
+        self.file = file
+        self.remaining = end - start
+    
+    def read(self, size):
+        data = self.file.read(min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+def parse_shard(shard):
+    """
+    Parse one byte range of a text log in a worker process. Return the aggregated edges
+    (see graph_edges), and the comments in the range.
+    """
+    logfile, start, end, flags = shard
     graph = StorageGraph()
+    comments = []
+    with MappedFile(logfile) as file:
+        for entry in parse_text(FileRange(file, start, end), "", flags):
+            if isinstance(entry, str):
+                comments.append(entry)
+            else:
+                graph.add_log_entry(entry)
+    return graph_edges(graph), comments
+
+def make_graph_sharded(logfile, flags, comment_callback=None):
+    import multiprocessing
+    shards = [ (logfile, start, end, flags) for start, end in shard_boundaries(logfile, flags.jobs) ]
+    pool = multiprocessing.Pool(min(flags.jobs, max(len(shards), 1)))
+    try:
+        results = pool.map(parse_shard, shards)
+    finally:
+        pool.close()
+        pool.join()
+    graph = StorageGraph()
+    for edges, comments in results:
+        if comment_callback:
+            for comment in comments:
+                comment_callback(comment)
+        graph.merge_edges(edges)
+    return graph
+
+# ====================================================================
+# ======== Follow mode
+# ====================================================================
+
+def follow(logfile, flags, render):
+    """
+    Parse the growing logfile until interrupted, and call render with the graph every flags.interval seconds,
+    if new entries were parsed. All storage nodes are shown (-a), since collapsing them would modify the graph.
+    """
+    if logfile == "-" or is_compressed(logfile) or not os.path.isfile(logfile):
+        print "Only plain logfiles can be followed."
+        exit(1)
+    flags.allstorage = True
+    graph = StorageGraph()
+    entries = [0, 0] # Parsed and rendered entries
     def callback(entry):
         graph.add_log_entry(entry)
-    parse(logfile, flags, callback)
-    graph.assert_sanity()
-    return graph
+        entries[0] += 1
+    def update():
+        if entries[1] != entries[0]:
+            entries[1] = entries[0]
+            print "==== %s: %s entries ====" % (time.strftime("%H:%M:%S"), format(entries[0], ",d"))
+            render(graph)
+            sys.stdout.flush()
+    # The header is needed to detect the format.
+    while os.path.getsize(logfile) < len(BINARY_MAGIC):
+        time.sleep(FollowFile.poll_interval)
+    try:
+        with io.open(logfile, 'rb') as file:
+            parse_file(FollowFile(file, update, flags.interval), flags, callback)
+    except KeyboardInterrupt:
+        pass
+
+class FollowFile(object):
+    """
+    File-like object that waits for a growing file instead of reaching its end,
+    and calls update at least every interval seconds.
+    """
+    
+    poll_interval = 0.1
+    
+    def __init__(self, file, update, interval):
+        self.file = file
+        self.update = update
+        self.interval = interval
+        self.next_update = time.time() + interval
+    
+    def read(self, size):
+        while True:
+            if time.time() >= self.next_update:
+                self.update()
+                self.next_update = time.time() + self.interval
+            data = self.file.read(size)
+            if data:
+                return data
+            time.sleep(min(self.poll_interval, self.interval))
+
+class FragmentCache(object):
+    """
+    Rendered output for parts of the graph, which is only rendered again if the version of the part changes.
+    """
+    
+    def __init__(self):
+        self.fragments = {}
+    
+    def get(self, key, version, render, *args):
+        fragment = self.fragments.get(key)
+        if fragment is None or fragment[0] != version:
+            fragment = (version, render(*args))
+            self.fragments[key] = fragment
+        return fragment[1]
+
+def captured_output(func, *args):
+    import StringIO
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        func(*args)
+        return sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
 
 # ====================================================================
 # ======== Command - Summarize log content
 # ====================================================================
 
 def command_summarize(logfile, flags):
+    if flags.follow:
+        fragments = FragmentCache()
+        def render(graph):
+            for node in graph.sorted_nodes():
+                version = (node.version(), len(graph.operations))
+                sys.stdout.write(fragments.get(node.name, version, captured_output, node.print_summary, flags, graph.operations))
+        follow(logfile, flags, render)
+        return
     graph = make_graph(logfile, flags)
     if not flags.allstorage:
         graph.collapse_nonstorage_nodes()
@@ -469,7 +1156,6 @@ def command_summarize(logfile, flags):
 
 def StorageNode_print_summary(self, flags, all_operations):
     print "\n%s:" % self.name
-    sum = StorageEdge()
     total_incoming = self.sum_all_incoming().total() if flags.percent else None
     
     print "\tIncoming:"
@@ -480,7 +1166,6 @@ def StorageNode_print_summary(self, flags, all_operations):
             edges = [ (operation, self.sum_incoming(operation)) ]
         for edgename, edge in edges:
             edge.print_with_name("\t\t\t", edgename, total_incoming, flags)
-            sum += edge
     
     print "\tOutgoing:"
     for operation in all_operations:
@@ -490,9 +1175,9 @@ def StorageNode_print_summary(self, flags, all_operations):
             edges = [ (operation, self.sum_outgoing(operation)) ]
         for edgename, edge in edges:
             edge.print_with_name("\t\t\t", edgename, total_incoming, flags)
-            sum -= edge
     
-    sum.print_with_name("\t", "Remaining", total_incoming, flags)
+    remaining = self.sum_all_incoming() - self.sum_all_outgoing()
+    remaining.print_with_name("\t", "Remaining", total_incoming, flags)
 
 StorageNode.print_summary = StorageNode_print_summary
 
@@ -506,6 +1191,8 @@ def StorageEdge_print_with_name(self, prefix, edgename, total_reference, flags):
         operations = [ (edgename, self.total()) ]
     for classname, classops in operations:
         classops.prefixprint("%s%s: " % (prefix, classname), total_reference)
+        if flags.histograms and classops.percentiles_string():
+            print "%s\t%s" % (prefix, classops.percentiles_string())
     
 StorageEdge.print_with_name = StorageEdge_print_with_name
 
@@ -515,16 +1202,27 @@ StorageEdge.print_with_name = StorageEdge_print_with_name
 
 # Output is valid dot code and can be parsed by the graphviz dot utility.
 def command_print_dot(logfile, flags):
-    graph = make_graph(logfile, flags)
-    print "/*"
-    print "Storage Statistics (dot format):"
-    print "================================"
-    print "*/"
-    print dot_string(graph, flags)
+    def render(graph, fragments=None):
+        print "/*"
+        print "Storage Statistics (dot format):"
+        print "================================"
+        print "*/"
+        print dot_string(graph, flags, fragments)
+    if flags.follow:
+        fragments = FragmentCache()
+        follow(logfile, flags, lambda graph: render(graph, fragments))
+    else:
+        render(make_graph(logfile, flags))
 
 def run_dot(logfile, flags, output_type):
-    import subprocess
-    dot = dot_string(make_graph(logfile, flags), flags)
+    if flags.follow:
+        # dot always renders the entire image, only the dot code is updated incrementally.
+        fragments = FragmentCache()
+        follow(logfile, flags, lambda graph: write_dot(dot_string(graph, flags, fragments), flags, output_type))
+    else:
+        write_dot(dot_string(make_graph(logfile, flags), flags), flags, output_type)
+
+def write_dot(dot, flags, output_type):
     command = ["dot", "-T%s" % output_type, "-o%s.%s" % (flags.logfile, output_type)]
     print "Running:\n%s" % " ".join(command)
     p = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
@@ -540,58 +1238,137 @@ def command_dot_pdf(logfile, flags):
 def command_dot_svg(logfile, flags):
     run_dot(logfile, flags, "svg")
 
-def dot_string(graph, flags):
-    result = "digraph G {"
-    incoming_cache = {}
+def dot_string(graph, flags, fragments=None):
+    """
+    Return the dot code for the graph. The code for nodes and edges is taken from
+    the given FragmentCache, if they did not change since it was rendered.
+    """
+    if fragments is None:
+        fragments = FragmentCache()
     if not flags.allstorage:
         graph.collapse_nonstorage_nodes("Other")
-    
-    def make_label(edge, prefix="", total_edge=None, slots_per_object=False):
-        object_suffix = " objects"
-        slots_suffix = " slots"
-        if not flags.objects or not flags.slots:
-            object_suffix = slots_suffix = ""
-        if total_edge and flags.percent and total_edge.objects != 0:
-            percent_objects = " (%.1f%%)" % percent(edge.objects, total_edge.objects)
-            percent_slots = " (%.1f%%)" % percent(edge.slots, total_edge.slots)
-        else:
-            percent_objects = percent_slots = ""
-        label = ""
-        if flags.objects:
-            label += "%s%s%s%s<BR/>" % (prefix, format(edge.objects, ",.0f"), object_suffix, percent_objects)
-        if flags.slots:
-            label += "%s%s%s%s<BR/>" % (prefix, format(edge.slots, ",.0f"), slots_suffix, percent_slots)
-        if slots_per_object and flags.slotsPerObject:
-            label += "%.1f slots/object<BR/>" % (float(total.slots) / total.objects)
-        return label
-    
+    result = "digraph G {"
+    incoming_cache = {}
+    versions = {}
     for node in graph.nodes.values():
-        incoming = node.sum_all_incoming().total()
-        outgoing = node.sum_all_outgoing().total()
-        remaining = incoming - outgoing
-        if node.is_artificial():
-            incoming_cache[node.name] = outgoing
-            shape = ",shape=box"
-            label = make_label(outgoing)
-        else:
-            incoming_cache[node.name] = incoming
-            shape = ""
-            label = make_label(incoming, "Incoming: ")
-            if remaining.objects != incoming.objects:
-                label += make_label(remaining, "Remaining: ", incoming)
-        result += "%s [label=<<B><U>%s</U></B><BR/>%s>%s];" % (node.dot_name(), node.name, label, shape)
-    
+        versions[node.name] = node.version()
+        node_string, incoming_cache[node.name] = fragments.get(node.name, versions[node.name], dot_node, node, flags)
+        result += node_string
     for edge in graph.edges.values():
-        total = edge.total()
-        incoming = incoming_cache[edge.origin.name]
-        label = make_label(total, "", incoming, slots_per_object=True)
-        target_node = edge.target.dot_name()
-        source_node = edge.origin.dot_name()
-        result += "%s -> %s [label=<%s>];" % (source_node, target_node, label)
-    
+        # With -p, edge labels depend on the incoming total of their origin.
+        version = (edge.version, versions[edge.origin.name]) if flags.percent else edge.version
+        result += fragments.get(edge.full_key(), version, dot_edge, edge, incoming_cache[edge.origin.name], flags)
     result += "}"
     return result
 
+def dot_node(node, flags):
+    """
+    Return the dot code for the node, and the total its outgoing edges are compared to.
+    """
+    incoming = node.sum_all_incoming().total()
+    outgoing = node.sum_all_outgoing().total()
+    remaining = incoming - outgoing
+    if node.is_artificial():
+        total = outgoing
+        shape = ",shape=box"
+        label = dot_label(outgoing, flags)
+    else:
+        total = incoming
+        shape = ""
+        label = dot_label(incoming, flags, "Incoming: ")
+        if remaining.objects != incoming.objects:
+            label += dot_label(remaining, flags, "Remaining: ", incoming)
+    return "%s [label=<<B><U>%s</U></B><BR/>%s>%s];" % (node.dot_name(), node.name, label, shape), total
+
+def dot_edge(edge, incoming, flags):
+    label = dot_label(edge.total(), flags, "", incoming, slots_per_object=True)
+    return "%s -> %s [label=<%s>];" % (edge.origin.dot_name(), edge.target.dot_name(), label)
+
+def dot_label(edge, flags, prefix="", total_edge=None, slots_per_object=False):
+    object_suffix = " objects"
+    slots_suffix = " slots"
+    if not flags.objects or not flags.slots:
+        object_suffix = slots_suffix = ""
+    if total_edge and flags.percent and total_edge.objects != 0:
+        percent_objects = " (%.1f%%)" % percent(edge.objects, total_edge.objects)
+        percent_slots = " (%.1f%%)" % percent(edge.slots, total_edge.slots)
+    else:
+        percent_objects = percent_slots = ""
+    label = ""
+    if flags.objects:
+        label += "%s%s%s%s<BR/>" % (prefix, format(edge.objects, ",.0f"), object_suffix, percent_objects)
+    if flags.slots:
+        label += "%s%s%s%s<BR/>" % (prefix, format(edge.slots, ",.0f"), slots_suffix, percent_slots)
+    if slots_per_object and flags.slotsPerObject:
+        label += "%.1f slots/object<BR/>" % (float(edge.slots) / edge.objects)
+    if slots_per_object and flags.histograms:
+        label += "%s<BR/>" % edge.percentiles_string().replace("<", "&lt;")
+    return label
+
+# ====================================================================
+# ======== Command - Memory footprint
+# ====================================================================
+
+slot_bytes_pattern = re.compile("^slot-bytes (\((?P<strategy>\w+)\)|(?P<generic>generic)) (?P<bytes>[0-9]+)$")
+
+def command_memory(logfile, flags):
+    """
+    Estimate the memory used by the remaining collections of every strategy,
+    based on the slot-bytes comments written by the logger.
+    """
+    slot_bytes = {}
+    generic = [None]
+    def comment_callback(comment):
+        result = slot_bytes_pattern.match(comment)
+        if result is None:
+            return
+        if result.group('generic'):
+            generic[0] = int(result.group('bytes'))
+        else:
+            name = result.group('strategy')
+            slot_bytes[NODE_RENAMINGS.get(name, name)] = int(result.group('bytes'))
+    graph = make_graph(logfile, flags, comment_callback)
+    generic = generic[0]
+    if generic is None:
+        print "No slot-bytes information found in the log."
+        return
+    def bytes_for(node):
+        if node.name not in slot_bytes:
+            if flags.verbose:
+                print "No slot-bytes information for %s, assuming %d." % (node.name, generic)
+            return generic
+        return slot_bytes[node.name]
+    
+    total_live = total_baseline = 0
+    print "Live memory:"
+    for node in graph.sorted_nodes():
+        if node.is_artificial():
+            continue
+        remaining = node.sum_all_incoming().total() - node.sum_all_outgoing().total()
+        live = remaining.slots * bytes_for(node)
+        baseline = remaining.slots * generic
+        total_live += live
+        total_baseline += baseline
+        print "\t%s: %s bytes in %s slots (%d bytes/slot), saved %s bytes" % (node.name,
+                format(live, ",d"), format(remaining.slots, ",d"), bytes_for(node), format(baseline - live, ",d"))
+    saved = total_baseline - total_live
+    print "Total: %s bytes, generic baseline %s bytes, saved %s bytes (%.1f%%)" % (
+            format(total_live, ",d"), format(total_baseline, ",d"), format(saved, ",d"), percent(saved, total_baseline))
+    
+    # Collections switching to a strategy with more bytes per slot lose part of the savings.
+    total_lost = 0
+    print "Transitions:"
+    for edge in sorted(graph.edges.values()):
+        if edge.is_storage_source:
+            continue
+        slots = edge.total().slots
+        lost = slots * (bytes_for(edge.target) - bytes_for(edge.origin))
+        if lost > 0:
+            total_lost += lost
+            print "\t%s -> %s: %s slots, lost %s bytes" % (edge.origin.name, edge.target.name,
+                    format(slots, ",d"), format(lost, ",d"))
+    print "Total lost to transitions: %s bytes" % format(total_lost, ",d")
+
 # ====================================================================
 # ======== Other commands
 # ====================================================================
@@ -617,21 +1394,34 @@ def command_print_entries(logfile, flags):
 
 class Flags(object):
     
-    def __init__(self, flags):
+    def __init__(self, flags, options=[]):
         self.flags = {}
         for name, short in flags:
             self.__dict__[name] = False
             self.flags[short] = name
+        # Options take a value from the following argument, converted to the type of the default.
+        self.options = {}
+        for name, short, default in options:
+            self.__dict__[name] = default
+            self.options[short] = name
     
-    def handle(self, arg):
+    def handle(self, arg, following_args=iter([])):
         if arg in self.flags:
             self.__dict__[self.flags[arg]] = True
             return True
+        elif arg in self.options:
+            name = self.options[arg]
+            try:
+                self.__dict__[name] = type(self.__dict__[name])(next(following_args))
+            except (StopIteration, ValueError):
+                return False
+            return True
         else:
             return False
     
     def __str__(self):
         descriptions = [ ("%s (%s)" % description) for description in self.flags.items() ]
+        descriptions += [ ("%s N (%s)" % description) for description in self.options.items() ]
         return "[%s]" % " | ".join(descriptions)
     
 def usage(flags, commands):
@@ -639,10 +1429,13 @@ def usage(flags, commands):
     print "Available commands: %s" % commands
     exit(1)
 
-def main(argv):
-    flags = Flags([
+def default_flags():
+    return Flags([
         # General
         ('verbose', '-v'),
+        ('debug', '-D'), # Check the consistency of the graph
+        ('nocache', '-C'),
+        ('follow', '-f'), # Follow a growing logfile (summarize and dot commands)
         
         # All outputs
         ('percent', '-p'),
@@ -651,12 +1444,24 @@ def main(argv):
         # Text outputs
         ('detailed', '-d'),
         ('classes', '-c'),
+        ('sites', '-l'), # Break down classes by allocation site (with -c)
         
         # dot outputs
         ('slots', '-s'),
         ('objects', '-o'),
         ('slotsPerObject', '-S'),
+        
+        # Text and dot outputs
+        ('histograms', '-H'),
+    ], [
+        # Parse plain text logs with N worker processes
+        ('jobs', '-j', 1),
+        # Seconds between outputs in follow mode
+        ('interval', '-i', 2.0),
     ])
+
+def main(argv):
+    flags = default_flags()
     
     command_prefix = "command_"
     module = sys.modules[__name__].__dict__
@@ -672,8 +1477,9 @@ def main(argv):
             SET_VM(vm_name)
             break
     command = argv[1]
-    for flag in argv[2:]:
-        if not flags.handle(flag):
+    args = iter(argv[2:])
+    for flag in args:
+        if not flags.handle(flag, args):
             usage(flags, commands)
     if command not in commands:
         usage(flags, commands)
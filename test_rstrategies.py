@@ -1,5 +1,5 @@
 
-import py
+import py, sys
 import rstrategies as rs
 from rpython.rlib.objectmodel import import_from_mixin
 
@@ -17,6 +17,23 @@ class W_Integer(W_AbstractObject):
     def __eq__(self, other):
         return isinstance(other, W_Integer) and self.value == other.value
 
+class W_Point(W_AbstractObject):
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+    def __eq__(self, other):
+        return isinstance(other, W_Point) and self.x == other.x and self.y == other.y
+
+class W_Char(W_AbstractObject):
+    interned = {}
+    def __init__(self, char):
+        self.char = char
+    @staticmethod
+    def get(char):
+        if char not in W_Char.interned:
+            W_Char.interned[char] = W_Char(char)
+        return W_Char.interned[char]
+
 class W_List(W_AbstractObject):
     rs.make_accessors()
     def __init__(self, strategy=None, size=0, elements=None):
@@ -54,6 +71,9 @@ class W_List(W_AbstractObject):
         assert self.strategy
         return self.strategy.store_all(self, elements)
 
+class W_VersionedList(W_List):
+    rs.make_accessors(version='version')
+
 w_nil = W_Object()
 
 # === Define concrete strategy classes
@@ -70,7 +90,7 @@ class AbstractStrategy(object):
 class Factory(rs.StrategyFactory):
     switching_log = []
     
-    def __init__(self, root_class):
+    def __init__(self, root_class, atomic_switches=False):
         self.decorate_strategies({
             EmptyStrategy: [GenericStrategy],
             NilStrategy: [IntegerOrNilStrategy, GenericStrategy],
@@ -78,8 +98,10 @@ class Factory(rs.StrategyFactory):
             WeakGenericStrategy: [],
                 IntegerStrategy: [IntegerOrNilStrategy, GenericStrategy],
             IntegerOrNilStrategy: [GenericStrategy],
+            PointStrategy: [GenericStrategy],
+            CharStrategy: [GenericStrategy],
         })
-        rs.StrategyFactory.__init__(self, root_class)
+        rs.StrategyFactory.__init__(self, root_class, atomic_switches=atomic_switches)
     
     def instantiate_strategy(self, strategy_type, w_self=None, size=0):
         return strategy_type(self, w_self, size)
@@ -111,6 +133,7 @@ class WeakGenericStrategy(AbstractStrategy):
 class IntegerStrategy(AbstractStrategy):
     import_from_mixin(rs.SingleTypeStrategy)
     contained_type = W_Integer
+    unwrapped_type = int
     def wrap(self, value): return W_Integer(value)
     def unwrap(self, value): return value.value
     def default_value(self): return W_Integer(0)
@@ -118,12 +141,29 @@ class IntegerStrategy(AbstractStrategy):
 class IntegerOrNilStrategy(AbstractStrategy):
     import_from_mixin(rs.TaggingStrategy)
     contained_type = W_Integer
+    unwrapped_type = int
     def wrap(self, value): return W_Integer(value)
     def unwrap(self, value): return value.value
     def default_value(self): return w_nil
     def wrapped_tagged_value(self): return w_nil
     def unwrapped_tagged_value(self): import sys; return sys.maxint
     
+class PointStrategy(AbstractStrategy):
+    import_from_mixin(rs.StructOfArraysStrategy)
+    contained_type = W_Point
+    field_count = 2
+    def default_value(self): return W_Point(0, 0)
+    def check_can_handle_field(self, value, field): return isinstance(value.y if field else value.x, int)
+    def unwrap_field(self, value, field): return value.y if field else value.x
+    def wrap_fields(self, fields): return W_Point(fields[0], fields[1])
+    
+class CharStrategy(AbstractStrategy):
+    import_from_mixin(rs.StringStrategy)
+    contained_type = W_Char
+    def default_value(self): return W_Char.get(" ")
+    def wrap(self, char): return W_Char.get(char)
+    def unwrap(self, value): return value.char
+    
 @rs.strategy(generalize=[], singleton=False)
 class NonSingletonStrategy(GenericStrategy):
     def __init__(self, factory, w_list=None, size=0):
@@ -150,7 +190,7 @@ def test_setup():
     pass
 
 def test_factory_setup():
-    expected_strategies = 7
+    expected_strategies = 9
     assert len(factory.strategies) == expected_strategies
     assert len(set(factory.strategies)) == len(factory.strategies)
     for strategy in factory.strategies:
@@ -172,6 +212,52 @@ def test_metaclass():
     assert NonStrategy._is_singleton == False
     assert NonStrategy.get_storage is not NonSingletonStrategy.get_storage
 
+def test_accessors():
+    l = W_VersionedList()
+    l._set_storage(5)
+    l._set_version(3)
+    assert l.storage == 5 and l._get_storage() == 5
+    assert l.version == 3 and l._get_version() == 3
+    py.test.raises(AssertionError, rs.make_attribute_accessors, "storage; x")
+
+def test_direct_storage_access(monkeypatch):
+    def get_storage(self, w_self):
+        assert False, "The factory should not be used to access the storage."
+    monkeypatch.setattr(Factory, "get_storage", get_storage)
+    l = W_List(GenericStrategy, 3)
+    assert l.fetch(0) is w_nil
+
+def test_routed_storage_access():
+    class RoutedStrategy(object):
+        __metaclass__ = rs.StrategyMetaclass
+        import_from_mixin(rs.AbstractStrategy)
+        import_from_mixin(rs.SafeIndexingMixin)
+        def __init__(self, factory, w_self=None, size=0):
+            self.factory = factory
+        def strategy_factory(self):
+            return self.factory
+    @rs.strategy()
+    class RoutedGenericStrategy(RoutedStrategy):
+        import_from_mixin(rs.GenericStrategy)
+        def default_value(self): return w_nil
+    class RoutingFactory(rs.StrategyFactory):
+        accesses = 0
+        def instantiate_strategy(self, strategy_type, w_self=None, size=0):
+            return strategy_type(self, w_self, size)
+        def get_storage(self, w_self):
+            self.accesses += 1
+            return w_self._get_storage()
+    routing_factory = RoutingFactory(RoutedStrategy)
+    l = W_List()
+    routing_factory.set_initial_strategy(l, RoutedGenericStrategy, 3)
+    assert l.fetch(1) is w_nil
+    accesses = routing_factory.accesses
+    assert accesses > 0
+    # Strategies of other factories are not affected.
+    assert GenericStrategy.get_storage is not RoutedGenericStrategy.get_storage
+    assert W_List(GenericStrategy, 3).fetch(1) is w_nil
+    assert routing_factory.accesses == accesses
+
 def test_singletons():
     def do_test_singletons(cls, expected_true):
         l1 = W_List(cls, 0)
@@ -223,6 +309,12 @@ def test_init_Integer():
 def test_init_IntegerOrNil():
     do_test_initialization(IntegerOrNilStrategy)
     
+def test_init_Char():
+    do_test_initialization(CharStrategy, default_value=W_Char.get(" "))
+    
+def test_init_Point():
+    do_test_initialization(PointStrategy, default_value=W_Point(0, 0))
+    
 # === Test Simple store
 
 def do_test_store(cls, stored_value=W_Object(), is_safe=True, is_varsize=False):
@@ -259,6 +351,12 @@ def test_store_Integer():
 def test_store_IntegerOrNil():
     do_test_store(IntegerOrNilStrategy, stored_value=W_Integer(100))
     do_test_store(IntegerOrNilStrategy, stored_value=w_nil)
+    
+def test_store_Char():
+    do_test_store(CharStrategy, stored_value=W_Char.get("a"))
+    
+def test_store_Point():
+    do_test_store(PointStrategy, stored_value=W_Point(3, 4))
 
 # === Test Insert
 
@@ -289,6 +387,12 @@ def test_insert_IntegerOrNil():
     do_test_insert(IntegerOrNilStrategy, [w_nil]+[W_Integer(x) for x in range(4)]+[w_nil])
     do_test_insert(IntegerOrNilStrategy, [w_nil]*6)
     
+def test_insert_Char():
+    do_test_insert(CharStrategy, [W_Char.get(c) for c in "abcdef"])
+    
+def test_insert_Point():
+    do_test_insert(PointStrategy, [W_Point(x, -x) for x in range(6)])
+    
 # === Test Delete
 
 def do_test_delete(cls, values):
@@ -316,6 +420,12 @@ def test_delete_Integer():
 def test_delete_IntegerOrNil():
     do_test_delete(IntegerOrNilStrategy, [w_nil]+[W_Integer(x) for x in range(4)]+[w_nil])
     do_test_delete(IntegerOrNilStrategy, [w_nil]*6)
+    
+def test_delete_Char():
+    do_test_delete(CharStrategy, [W_Char.get(c) for c in "abcdef"])
+    
+def test_delete_Point():
+    do_test_delete(PointStrategy, [W_Point(x, -x) for x in range(6)])
 
 # === Test Transitions
 
@@ -336,6 +446,8 @@ def test_CheckCanHandle():
     assert_handles(WeakGenericStrategy, [nil, obj, i], [])
     assert_handles(IntegerStrategy, [i], [nil, obj])
     assert_handles(IntegerOrNilStrategy, [nil, i], [obj])
+    assert_handles(PointStrategy, [W_Point(1, 2)], [nil, obj, i])
+    assert_handles(CharStrategy, [W_Char.get("a")], [nil, obj, i])
 
 def do_test_transition(OldStrategy, value, NewStrategy, initial_size=10):
     w = W_List(OldStrategy, initial_size)
@@ -359,6 +471,55 @@ def test_Integer_to_IntegerOrNil():
 def test_Integer_Generic():
     do_test_transition(IntegerStrategy, W_Object(), GenericStrategy)
 
+def test_Point_to_Generic():
+    do_test_transition(PointStrategy, W_Integer(0), GenericStrategy)
+
+def test_Point_field_to_Generic():
+    do_test_transition(PointStrategy, W_Point(1, 2.5), GenericStrategy)
+    factory.clear_log()
+    do_test_transition(PointStrategy, W_Point(W_Object(), 2), GenericStrategy)
+
+def test_Char_to_Generic():
+    do_test_transition(CharStrategy, W_Object(), GenericStrategy)
+
+def test_Char_host_string():
+    string = "hello world"
+    l = W_List()
+    factory.set_initial_strategy_unwrapped(l, CharStrategy, string)
+    assert l.fetch(4) is W_Char.get("o")
+    assert factory.export_raw(l)[2] is string
+    l.store(0, W_Char.get("j"))
+    l.delete(5, 11)
+    assert l.fetch(0) is W_Char.get("j")
+    assert factory.export_raw(l)[2] == "jello"
+    l.append([W_Char.get("!")])
+    assert l.strategy.export_raw(l) == "jello!"
+
+def test_Char_copy():
+    string = "hello"
+    l = W_List()
+    factory.set_initial_strategy_unwrapped(l, CharStrategy, string, copy=True)
+    assert factory.export_raw(l)[2] is string
+    chars = list("hello")
+    l = W_List()
+    factory.set_initial_strategy_unwrapped(l, CharStrategy, chars, copy=True)
+    l.store(0, W_Char.get("j"))
+    assert chars[0] == "h"
+    assert factory.export_raw(l)[2] == "jello"
+
+def test_convert_to_Char():
+    l = W_List(GenericStrategy, 2, [W_Char.get("a"), W_Char.get("b")])
+    factory.switch_strategy(l, CharStrategy)
+    assert l.strategy.export_raw(l) == "ab"
+
+def test_Point_fields():
+    l = W_List(PointStrategy, 3, [W_Point(1, 2), W_Point(3, 4), W_Point(5, 6)])
+    assert l.strategy.fetch_field(l, 0) == [1, 3, 5]
+    assert l.strategy.fetch_field(l, 1) == [2, 4, 6]
+    l.strategy.store_field_value(l, 1, 0, 10)
+    assert l.strategy.fetch_field_value(l, 1, 0) == 10
+    assert l.fetch(1) == W_Point(10, 4)
+
 def test_TaggingValue_not_storable():
     tag = IntegerOrNilStrategy(10).unwrapped_tagged_value() # sys.maxint
     do_test_transition(IntegerOrNilStrategy, W_Integer(tag), GenericStrategy)
@@ -411,24 +572,728 @@ def test_store_all():
     
     py.test.raises(IndexError, l.store_all, [W_Object() for _ in range(8) ])
 
+# === Test range checks
+
+def test_delete_until_end():
+    for cls, values in [(NilStrategy, [w_nil]*4), (IntegerStrategy, [W_Integer(x) for x in range(4)])]:
+        l = W_List(cls, len(values), values)
+        l.delete(2, 4)
+        check_contents(l, values[:2])
+        assert l.pop(1) == values[1]
+        check_contents(l, values[:1])
+        assert l.slice(1, 1) == []
+        py.test.raises(IndexError, l.delete, 0, 2)
+        py.test.raises(IndexError, l.slice, -1, 1)
+        py.test.raises(IndexError, l.pop, 1)
+
+def test_store_all_generalizes():
+    values = [W_Integer(1), W_Object(), W_Integer(3), w_nil]
+    l = W_List(IntegerStrategy, len(values))
+    l.store_all(values)
+    assert isinstance(l.strategy, GenericStrategy)
+    assert l.fetch_all() == values
+
+def test_range_operations_read_size_once(monkeypatch):
+    l = W_List(IntegerStrategy, 20)
+    size_reads = []
+    original_size = IntegerStrategy.size.im_func
+    def size(self, w_self):
+        size_reads.append(w_self)
+        return original_size(self, w_self)
+    monkeypatch.setattr(IntegerStrategy, "size", size)
+    for operation in [lambda: l.slice(0, 20), lambda: l.store_all([W_Integer(1)] * 20), lambda: l.pop(0)]:
+        del size_reads[:]
+        operation()
+        assert len(size_reads) == 1
+    assert l.fetch_all() == [W_Integer(1)] * 19
+
+def test_conversions_check_range_once(monkeypatch):
+    checks = []
+    monkeypatch.setattr(IntegerStrategy, "check_index_range", lambda self, w_self, start, end: checks.append((start, end)))
+    monkeypatch.setattr(IntegerStrategy, "check_index_fetch", lambda self, w_self, index0: checks.append(index0))
+    for strategy_type in [GenericStrategy, IntegerOrNilStrategy]:
+        l = W_List(IntegerStrategy, 5)
+        del checks[:]
+        factory.switch_strategy(l, strategy_type)
+        assert checks == [(0, 5)]
+
+# === Test unwrapped initialization
+
+def test_init_unwrapped_Integer():
+    storage = [1, 2, 3]
+    l = W_List()
+    factory.set_initial_strategy_unwrapped(l, IntegerStrategy, storage)
+    assert isinstance(l.strategy, IntegerStrategy)
+    check_contents(l, [W_Integer(1), W_Integer(2), W_Integer(3)])
+    assert factory.get_storage(l) is not None
+    l.store(0, W_Integer(5))
+    assert storage[0] == 5, "Buffer should have been adopted, not copied."
+
+def test_init_unwrapped_copy():
+    storage = [1, 2, 3]
+    l = W_List()
+    factory.set_initial_strategy_unwrapped(l, IntegerStrategy, storage, copy=True)
+    l.store(0, W_Integer(5))
+    assert storage[0] == 1
+    check_contents(l, [W_Integer(5), W_Integer(2), W_Integer(3)])
+    fields = [[1, 3], [2, 4]]
+    l = W_List()
+    factory.set_initial_strategy_unwrapped(l, PointStrategy, fields, copy=True)
+    l.store(0, W_Point(5, 6))
+    assert fields == [[1, 3], [2, 4]]
+
+def test_init_unwrapped_not_adoptable():
+    # Buffers that are not stored as they are, are copied even without copy=True.
+    import array
+    storage = array.array('l', [1, 2, 3])
+    l = W_List()
+    factory.set_initial_strategy_unwrapped(l, IntegerStrategy, storage)
+    assert l.strategy.export_raw(l) == [1, 2, 3]
+    l.store(0, W_Integer(5))
+    assert storage[0] == 1
+    l = W_List()
+    factory.set_initial_strategy_unwrapped(l, CharStrategy, ["a", "b"])
+    assert l.strategy.export_raw(l) == "ab"
+    fields = [[1, 3], (2, 4)]
+    l = W_List()
+    factory.set_initial_strategy_unwrapped(l, PointStrategy, fields)
+    check_contents(l, [W_Point(1, 2), W_Point(3, 4)])
+    l.store(0, W_Point(5, 6))
+    assert fields == [[1, 3], (2, 4)]
+
+def test_init_unwrapped_checked_types():
+    integer = factory.strategy_singleton_instance(IntegerStrategy)
+    assert integer.check_can_handle_storage([1, 2, 3])
+    assert not integer.check_can_handle_storage([1, 2.5])
+    integer_or_nil = factory.strategy_singleton_instance(IntegerOrNilStrategy)
+    assert integer_or_nil.check_can_handle_storage([1, sys.maxint])
+    assert not integer_or_nil.check_can_handle_storage([1, "a"])
+    l = W_List()
+    factory.set_initial_strategy_unwrapped(l, IntegerOrNilStrategy, [1, sys.maxint])
+    assert isinstance(l.strategy, IntegerOrNilStrategy)
+    check_contents(l, [W_Integer(1), w_nil])
+
+def test_init_unwrapped_Empty():
+    l = W_List()
+    factory.set_initial_strategy_unwrapped(l, EmptyStrategy, [])
+    assert isinstance(l.strategy, EmptyStrategy)
+    assert l.size() == 0
+
+def test_init_unwrapped_rejected(monkeypatch):
+    monkeypatch.setattr(IntegerStrategy, "check_can_handle_storage", lambda self, storage: False)
+    l = W_List()
+    factory.set_initial_strategy_unwrapped(l, IntegerOrNilStrategy, [1, sys.maxint])
+    assert isinstance(l.strategy, IntegerOrNilStrategy)
+    check_contents(l, [W_Integer(1), w_nil])
+    storage = [1, 2]
+    l = W_List()
+    factory.set_initial_strategy_unwrapped(l, IntegerStrategy, storage)
+    assert isinstance(l.strategy, IntegerStrategy)
+    check_contents(l, [W_Integer(1), W_Integer(2)])
+    l.store(0, W_Integer(5))
+    assert storage[0] == 1, "Rejected buffer should not be adopted."
+
+def test_init_unwrapped_rejected_wraps(monkeypatch):
+    monkeypatch.setattr(CharStrategy, "check_can_handle_storage", lambda self, storage: False)
+    l = W_List()
+    factory.set_initial_strategy_unwrapped(l, CharStrategy, "ab")
+    assert isinstance(l.strategy, CharStrategy)
+    check_contents(l, [W_Char.get("a"), W_Char.get("b")])
+    monkeypatch.setattr(PointStrategy, "check_can_handle_storage", lambda self, storage: False)
+    l = W_List()
+    factory.set_initial_strategy_unwrapped(l, PointStrategy, [[1, 3], [2, 4]])
+    assert isinstance(l.strategy, PointStrategy)
+    check_contents(l, [W_Point(1, 2), W_Point(3, 4)])
+
+def test_init_unwrapped_SingleValue():
+    l = W_List()
+    factory.set_initial_strategy_unwrapped(l, NilStrategy, [w_nil] * 3)
+    assert isinstance(l.strategy, NilStrategy)
+    check_contents(l, [w_nil] * 3)
+    l = W_List()
+    factory.set_initial_strategy_unwrapped(l, NilStrategy, [w_nil, W_Integer(1)])
+    assert isinstance(l.strategy, IntegerOrNilStrategy)
+    check_contents(l, [w_nil, W_Integer(1)])
+
+def test_init_unwrapped_rejected_not_logged(monkeypatch):
+    monkeypatch.setattr(IntegerStrategy, "check_can_handle_storage", lambda self, storage: False)
+    new_factory = Factory(AbstractStrategy)
+    new_factory.logger.activate(aggregate=True)
+    new_factory.set_initial_strategy_unwrapped(W_List(), IntegerStrategy, [1, 2], log=False)
+    new_factory.log_created_batch(IntegerStrategy, 1, 2)
+    assert sum([ entry.objects for entry in new_factory.logger.logs.values() ]) == 1
+
+def test_log_created_batch():
+    new_factory = Factory(AbstractStrategy)
+    new_factory.logger.activate(aggregate=True)
+    new_factory.log_created_batch(IntegerStrategy, 10, 50)
+    new_factory.log_created_batch(IntegerStrategy, 5, 20)
+    entry = new_factory.logger.logs[("Created", "", "IntegerStrategy", "", "")]
+    assert entry.objects == 15
+    assert entry.slots == 70
+
+def test_log_histogram():
+    new_factory = Factory(AbstractStrategy)
+    new_factory.logger.activate(aggregate=True)
+    for size in [0, 1, 3, 3, 100]:
+        new_factory.set_initial_strategy(W_List(), IntegerStrategy, size, [W_Integer(1)] * size)
+    entry = new_factory.logger.logs[("Created", "", "IntegerStrategy", "W_List", "")]
+    assert entry.histogram == [1, 1, 2, 0, 0, 0, 0, 1]
+
+def test_log_allocation_site(monkeypatch):
+    new_factory = Factory(AbstractStrategy)
+    new_factory.logger.activate(aggregate=True)
+    monkeypatch.setattr(new_factory, "log_allocation_site", lambda w_self: "test.py:1")
+    l = W_VersionedList()
+    new_factory.set_initial_strategy(l, IntegerStrategy, 1, [W_Integer(1)])
+    new_factory.switch_strategy(l, GenericStrategy)
+    assert set(new_factory.logger.logs.keys()) == set([
+        ("Created", "", "IntegerStrategy", "W_VersionedList", "test.py:1"),
+        ("Switched", "IntegerStrategy", "GenericStrategy", "W_VersionedList", "test.py:1")])
+
+def test_access_profiling():
+    import rstrategies_logger
+    new_factory = Factory(AbstractStrategy)
+    logger = new_factory.logger
+    logger.activate_profiling(profile_classes=True)
+    l = W_List()
+    new_factory.set_initial_strategy(l, IntegerStrategy, 3, [W_Integer(1)] * 3)
+    l.strategy.fetch(l, 0)
+    l.strategy.fetch(l, 1)
+    l.strategy.slice(l, 0, 3)
+    l.strategy.insert(l, 0, [W_Integer(2)] * 2)
+    integer = new_factory.strategy_id(l.strategy)
+    def index(operation):
+        return integer * len(rstrategies_logger.PROFILE_OPERATIONS) + operation
+    fetch = index(rstrategies_logger.PROFILE_FETCH)
+    assert logger.profiled_calls[fetch] == 2
+    assert logger.profiled_elements[fetch] == 2
+    assert logger.profiled_elements[index(rstrategies_logger.PROFILE_SLICE)] == 3
+    assert logger.profiled_elements[index(rstrategies_logger.PROFILE_INSERT)] == 2
+    assert logger.class_profiles[("W_List", fetch)] == [2, 2]
+    # Including the store_all() call initializing the list.
+    assert sum(logger.profiled_calls) == 5
+    # Conversions are not counted.
+    for values, strategy_type in [([W_Point(1, 2)], PointStrategy), ([W_Char.get("a")], CharStrategy)]:
+        l = W_List()
+        new_factory.set_initial_strategy_unwrapped(l, GenericStrategy, values)
+        new_factory.switch_strategy(l, strategy_type)
+        new_factory.switch_strategy(l, GenericStrategy)
+    assert sum(logger.profiled_calls) == 5
+
+def test_access_profiling_generalized():
+    import rstrategies_logger
+    new_factory = Factory(AbstractStrategy)
+    logger = new_factory.logger
+    logger.activate_profiling()
+    def calls(strategy_type, operation):
+        strategy_id = new_factory.strategy_id(new_factory.strategy_singleton_instance(strategy_type))
+        return logger.profiled_calls[strategy_id * len(rstrategies_logger.PROFILE_OPERATIONS) + operation]
+    l = W_List()
+    new_factory.set_initial_strategy(l, EmptyStrategy, 0)
+    # Accesses are counted once, by the strategy they were called on.
+    l.strategy.store(l, 0, W_Integer(1))
+    assert calls(EmptyStrategy, rstrategies_logger.PROFILE_STORE) == 1
+    integer_strategy = type(l.strategy)
+    l.strategy.store(l, 0, W_Object())
+    l.strategy.insert(l, 0, [W_Integer(2), W_Object()])
+    l.strategy.fetch(l, 0)
+    py.test.raises(IndexError, new_factory.strategy_singleton_instance(EmptyStrategy).fetch, W_List(), 0)
+    assert calls(integer_strategy, rstrategies_logger.PROFILE_STORE) == 1
+    assert calls(GenericStrategy, rstrategies_logger.PROFILE_INSERT) == 1
+    assert calls(EmptyStrategy, rstrategies_logger.PROFILE_FETCH) == 1
+    assert sum(logger.profiled_calls) == 5
+    assert sum(logger.profiled_elements) == 6
+
+def test_log_counters():
+    new_factory = Factory(AbstractStrategy)
+    new_factory.logger.activate_counters()
+    l = W_List()
+    new_factory.set_initial_strategy(l, IntegerStrategy, 3, [W_Integer(1)] * 3)
+    new_factory.switch_strategy(l, GenericStrategy)
+    new_factory.log_created_batch(IntegerStrategy, 10, 50)
+    logger = new_factory.logger
+    n = len(new_factory.strategy_names)
+    integer = new_factory.strategy_id(new_factory.strategy_singleton_instance(IntegerStrategy))
+    generic = new_factory.strategy_id(l.strategy)
+    assert logger.counted_objects[integer] == 11
+    assert logger.counted_slots[integer] == 53
+    assert logger.counted_objects[(integer + 1) * n + generic] == 1
+    assert logger.counted_slots[(integer + 1) * n + generic] == 3
+    assert logger.converted_elements == 3
+    assert sum(logger.counted_objects) == 12
+    assert logger.logs == {}
+
+def test_log_timing(monkeypatch):
+    new_factory = Factory(AbstractStrategy)
+    logger = new_factory.logger
+    logger.activate_timing()
+    times = iter([1.0, 3.0, 10.0, 11.0])
+    monkeypatch.setattr(logger, "timer", lambda: next(times))
+    for i in range(2):
+        l = W_List()
+        new_factory.set_initial_strategy(l, IntegerStrategy, 3, [W_Integer(1)] * 3)
+        new_factory.switch_strategy(l, GenericStrategy)
+    n = len(new_factory.strategy_names)
+    integer = new_factory.strategy_id(new_factory.strategy_singleton_instance(IntegerStrategy))
+    generic = new_factory.strategy_id(l.strategy)
+    index = integer * n + generic
+    assert logger.timed_switches[index] == 2
+    assert logger.total_times[index] == 3.0
+    assert logger.max_times[index] == 2.0
+    assert sum(logger.timed_switches) == 2
+
+def test_log_sinks():
+    import os, rstrategies_logger
+    for sink_class in [rstrategies_logger.TextSink, rstrategies_logger.BinarySink]:
+        read_fd, write_fd = os.pipe()
+        new_factory = Factory(AbstractStrategy)
+        new_factory.logger.activate()
+        new_factory.logger.set_sink(sink_class(write_fd))
+        new_factory.log_created_batch(IntegerStrategy, 10, 50)
+        new_factory.logger.flush()
+        os.close(write_fd)
+        output = os.read(read_fd, 1024)
+        os.close(read_fd)
+        if sink_class is rstrategies_logger.TextSink:
+            assert "# slot-bytes (IntegerStrategy) 8\n" in output
+            assert output.endswith("\nCreated (IntegerStrategy) size 50 objects 10\n")
+        else:
+            assert output.startswith(rstrategies_logger.BINARY_MAGIC)
+            assert "IntegerStrategy" in output
+
+def test_log_print_all(monkeypatch):
+    import rstrategies_logger
+    new_factory = Factory(AbstractStrategy)
+    logger = new_factory.logger
+    logger.activate(aggregate=True)
+    logger.activate_counters()
+    logger.activate_timing()
+    logger.activate_profiling()
+    l = W_List()
+    new_factory.set_initial_strategy(l, IntegerStrategy, 3, [W_Integer(1)] * 3)
+    new_factory.switch_strategy(l, GenericStrategy)
+    comments = []
+    monkeypatch.setattr(logger.sink, "write_comment", comments.append)
+    monkeypatch.setattr(logger.sink, "write_entry", lambda *args: None)
+    logger.print_all()
+    assert len([ c for c in comments if c.startswith("time ") ]) == 1
+    assert len([ c for c in comments if c.startswith("profile ") ]) == 1
+    assert comments[-1].startswith("profile ")
+
+def test_log_print_timings_once(monkeypatch):
+    # VMs calling print_aggregated_log() and print_counters() directly get the times and profile once.
+    for aggregate, counters in [(True, False), (False, True), (True, True)]:
+        new_factory = Factory(AbstractStrategy)
+        logger = new_factory.logger
+        logger.activate(aggregate=aggregate)
+        if counters:
+            logger.activate_counters()
+        logger.activate_timing()
+        logger.activate_profiling()
+        l = W_List()
+        new_factory.set_initial_strategy(l, IntegerStrategy, 3, [W_Integer(1)] * 3)
+        new_factory.switch_strategy(l, GenericStrategy)
+        comments = []
+        monkeypatch.setattr(logger.sink, "write_comment", comments.append)
+        monkeypatch.setattr(logger.sink, "write_entry", lambda *args: None)
+        logger.print_aggregated_log()
+        logger.print_counters()
+        assert len([ c for c in comments if c.startswith("time ") ]) == 1
+        assert len([ c for c in comments if c.startswith("profile ") ]) == 1
+
+def test_log_sampling():
+    def log_lists(sizes, **sampling):
+        new_factory = Factory(AbstractStrategy)
+        new_factory.logger.activate(aggregate=True, **sampling)
+        lists = [ W_List() for size in sizes ]
+        for l, size in zip(lists, sizes):
+            new_factory.set_initial_strategy(l, IntegerStrategy, size, [W_Integer(1)] * size)
+        return new_factory.logger.logs[("Created", "", "IntegerStrategy", "W_List", "")]
+    entry = log_lists([2] * 10, sample_rate=5)
+    assert entry.objects == 10
+    assert entry.slots == 20
+    entry = log_lists([2] * 10 + [100], sample_rate=5, always_log_size=100)
+    assert entry.objects == 11
+    assert entry.slots == 120
+    entry = log_lists([2] * 1000, sample_rate=4, sample_collections=True)
+    assert 0 < entry.objects < 2000
+    assert entry.objects % 4 == 0
+    assert entry.slots == 2 * entry.objects
+
+# === Test raw export and import
+
+def do_test_export_import(cls, values):
+    l = W_List(cls, len(values), values)
+    strategy_type, size, raw = factory.export_raw(l)
+    assert strategy_type is cls
+    assert size == len(values)
+    l2 = W_List()
+    factory.import_raw(l2, strategy_type, size, raw)
+    assert isinstance(l2.strategy, cls)
+    check_contents(l2, values)
+    return raw
+
+def test_export_import_Empty():
+    assert do_test_export_import(EmptyStrategy, []) is None
+
+def test_export_import_Nil():
+    assert do_test_export_import(NilStrategy, [w_nil]*4) == (w_nil, 4)
+
+def test_export_import_Generic():
+    values = [W_Object() for _ in range(4)]
+    assert do_test_export_import(GenericStrategy, values) == values
+
+def test_export_import_Integer():
+    assert do_test_export_import(IntegerStrategy, [W_Integer(x) for x in range(4)]) == range(4)
+
+def test_export_import_Point():
+    raw = do_test_export_import(PointStrategy, [W_Point(1, 2), W_Point(3, 4)])
+    assert raw == [[1, 3], [2, 4]]
+
+def test_convert_to_Point():
+    l = W_List(GenericStrategy, 2, [W_Point(1, 2), W_Point(3, 4)])
+    factory.switch_strategy(l, PointStrategy)
+    assert isinstance(l.strategy, PointStrategy)
+    check_contents(l, [W_Point(1, 2), W_Point(3, 4)])
+
+def test_export_import_IntegerOrNil():
+    raw = do_test_export_import(IntegerOrNilStrategy, [W_Integer(1), w_nil])
+    assert raw == [1, sys.maxint]
+
+# === Test atomic strategy switches
+
+def test_atomic_switch_version():
+    atomic_factory = Factory(AbstractStrategy, atomic_switches=True)
+    l = W_VersionedList()
+    atomic_factory.set_initial_strategy(l, NilStrategy, 3)
+    assert l.version == 0
+    atomic_factory.switch_strategy(l, IntegerOrNilStrategy)
+    assert l.version == 2
+    assert atomic_factory.read_consistent(l, lambda s: s.fetch(l, 1)) == w_nil
+
+def test_atomic_switch_nested(monkeypatch):
+    atomic_factory = Factory(AbstractStrategy, atomic_switches=True)
+    l = W_VersionedList()
+    atomic_factory.set_initial_strategy(l, NilStrategy, 3)
+    versions = []
+    def strategy_switched(self, w_self):
+        versions.append(w_self.version)
+        atomic_factory.switch_strategy(w_self, GenericStrategy)
+        versions.append(w_self.version)
+    monkeypatch.setattr(IntegerOrNilStrategy, "strategy_switched", strategy_switched)
+    atomic_factory.switch_strategy(l, IntegerOrNilStrategy)
+    assert isinstance(l.strategy, GenericStrategy)
+    assert versions == [1, 1]
+    assert l.version == 2
+
+def test_atomic_switch_concurrent_read():
+    atomic_factory = Factory(AbstractStrategy, atomic_switches=True)
+    l = W_VersionedList()
+    atomic_factory.set_initial_strategy(l, NilStrategy, 3)
+    reads = []
+    def read(strategy):
+        reads.append(strategy)
+        if len(reads) == 1:
+            # Simulate a switch by another thread, while reading.
+            atomic_factory.switch_strategy(l, GenericStrategy)
+        return strategy.size(l)
+    assert atomic_factory.read_consistent(l, read) == 3
+    assert [ s.__class__ for s in reads ] == [NilStrategy, GenericStrategy]
+
+def test_atomic_switch_threads():
+    import threading
+    atomic_factory = Factory(AbstractStrategy, atomic_switches=True)
+    lists = []
+    for _ in range(200):
+        l = W_VersionedList()
+        atomic_factory.set_initial_strategy(l, NilStrategy, 10)
+        lists.append(l)
+    def switch():
+        for l in lists:
+            atomic_factory.switch_strategy(l, IntegerOrNilStrategy)
+            atomic_factory.switch_strategy(l, GenericStrategy)
+    thread = threading.Thread(target=switch)
+    thread.start()
+    while thread.is_alive():
+        for l in lists:
+            assert atomic_factory.read_consistent(l, lambda s: s.fetch(l, 9)) == w_nil
+    thread.join()
+
 # === Test Weak Strategy
-# TODO
+
+def weak_list(values):
+    l = W_List(WeakGenericStrategy, len(values))
+    l.store_all(values)
+    return l
+
+def test_weak_store_reuses_reference():
+    o = W_Object()
+    l = weak_list([o, w_nil])
+    storage = l.strategy.get_storage(l).refs
+    ref = storage[0]
+    l.store(0, o)
+    assert storage[0] is ref
+    l.store(1, o)
+    assert l.fetch(1) is o
+
+def test_weak_count_live_and_compact():
+    values = [W_Object() for _ in range(6)]
+    l = weak_list(values)
+    assert l.strategy.count_live(l) == 6
+    del values[4]
+    del values[1]
+    assert l.strategy.count_live(l) == 4
+    assert l.fetch(1) is w_nil
+    assert l.strategy.compact(l, 0, 3) == 1
+    assert l.size() == 5
+    assert l.strategy.compact(l) == 1
+    assert l.fetch_all() == values
+    assert l.strategy.compact(l) == 0
+    py.test.raises(IndexError, l.strategy.compact, l, 2, 10)
+
+def test_weak_shared_references():
+    l = W_List(WeakGenericStrategy, 5)
+    refs = l.strategy.get_storage(l).refs
+    assert len(set(refs)) == 1
+    o = W_Object()
+    l.store_all([o] * 5)
+    assert len(set(refs)) == 1
+    assert refs[0]() is o
+    l.insert(2, [o, o])
+    assert len(set(refs)) == 1
+    values = [W_Object(), W_Object()]
+    l2 = weak_list(values)
+    assert l2.strategy.get_storage(l2).refs[0] is not l2.strategy.get_storage(l2).refs[1]
+    assert l2.fetch_all() == values
+
+def test_weak_compact_in_place():
+    values = [W_Object() for _ in range(6)]
+    l = weak_list(values)
+    refs = l.strategy.get_storage(l).refs
+    del values[3]
+    del values[0]
+    assert l.strategy.compact(l, 2, 6) == 1
+    assert l.strategy.compact(l) == 1
+    assert l.strategy.get_storage(l).refs is refs
+    assert l.fetch_all() == values
 
 # === Other tests
 
 def test_optimized_strategy_switch(monkeypatch):
-    l = W_List(NilStrategy, 5)
-    s = l.strategy
-    s.copied = 0
+    copied = []
     def convert_storage_from_default(self, w_self, other):
         assert False, "The default convert_storage_from() should not be called!"
     def convert_storage_from_special(self, w_self, other):
-        s.copied += 1
-    
-    monkeypatch.setattr(AbstractStrategy, "convert_storage_from_NilStrategy", convert_storage_from_special)
-    monkeypatch.setattr(AbstractStrategy, "convert_storage_from", convert_storage_from_default)
-    try:
-        factory.switch_strategy(l, IntegerOrNilStrategy)
-    finally:
-        monkeypatch.undo()
-    assert s.copied == 1, "Optimized switching routine not called exactly one time."
+        copied.append(other)
+    
+    monkeypatch.setattr(IntegerOrNilStrategy, "convert_storage_from_NilStrategy", convert_storage_from_special)
+    monkeypatch.setattr(IntegerOrNilStrategy, "convert_storage_from", convert_storage_from_default)
+    new_factory = Factory(AbstractStrategy)
+    l = W_List()
+    new_factory.set_initial_strategy(l, NilStrategy, 5)
+    s = l.strategy
+    new_factory.switch_strategy(l, IntegerOrNilStrategy)
+    assert copied == [s], "Optimized switching routine not called exactly one time."
+
+def test_strategy_ids():
+    strategy_ids = [ factory.strategy_id(factory.strategy_singleton_instance(s)) for s in factory.strategies ]
+    assert strategy_ids == range(len(factory.strategies))
+    assert factory.strategy_id(NonStrategy(factory)) == len(factory.strategies)
+    assert len(factory.strategy_names) == len(factory.strategies) + 1
+    assert len(factory.conversions) == len(factory.strategy_names) ** 2
+    assert not hasattr(AbstractStrategy, "convert_storage_from_NilStrategy")
+
+def test_generalization_table():
+    nil = factory.strategy_singleton_instance(NilStrategy)
+    assert factory.generalized_strategy_for(nil, W_Integer(1)) is IntegerOrNilStrategy
+    assert factory.generalized_strategy_for(nil, W_Object()) is GenericStrategy
+    generic = factory.strategy_singleton_instance(GenericStrategy)
+    py.test.raises(Exception, factory.generalized_strategy_for, generic, W_Object())
+    # The unroll_safe loops of generalized_strategy_for read a flat table of ids.
+    assert len(factory.generalization_starts) == len(factory.strategy_names) + 1
+    for strategy_type in factory.strategies:
+        strategy_id = factory.strategy_id(factory.strategy_singleton_instance(strategy_type))
+        start, end = factory.generalization_starts[strategy_id], factory.generalization_starts[strategy_id + 1]
+        generalized = [ factory.strategies[i] for i in factory.generalizations[start:end] ]
+        assert generalized == (strategy_type._generalizations or [])
+
+def test_collect_subclasses_diamond():
+    class Root(object): pass
+    class A(Root): pass
+    class B(Root): pass
+    class C(A, B): pass
+    assert factory.collect_subclasses(Root) == [A, C, B]
+
+def test_unreachable_strategies():
+    assert set(factory.unreachable_strategies) == set([WeakGenericStrategy, NonSingletonStrategy])
+
+def make_strategy_lattice(layers, width):
+    class Root(object):
+        __metaclass__ = rs.StrategyMetaclass
+    lattice = []
+    generalize = []
+    for i in range(layers):
+        layer = [ type("S_%i_%i" % (i, j), (Root,), {}) for j in range(width) ]
+        for strategy in layer:
+            rs.strategy(generalize)(strategy)
+        lattice.append(layer)
+        generalize = layer
+    return Root, lattice
+
+def test_order_strategies_lattice():
+    # Every strategy generalizes to all strategies of the previous layer,
+    # which has an exponential number of paths.
+    Root, lattice = make_strategy_lattice(40, 3)
+    new_factory = rs.StrategyFactory(Root)
+    depths = [ int(s.__name__.split("_")[1]) for s in new_factory.strategies ]
+    assert depths == sorted(depths, reverse=True)
+    assert new_factory.unreachable_strategies == []
+
+def test_generalization_cycle():
+    Root, lattice = make_strategy_lattice(3, 1)
+    rs.strategy(lattice[2][0:1])(lattice[0][0])
+    py.test.raises(Exception, rs.StrategyFactory, Root)
+
+def test_unrolling_bounded(monkeypatch):
+    # Simulate constant list sizes, as seen by the JIT. Loops over more than
+    # UNROLL_CUTOFF elements must not be unrolled into traces.
+    # This only tests the predicates of jit.look_inside_iff, not actual traces.
+    from rpython.rlib import jit
+    monkeypatch.setattr(jit, "isconstant", lambda value: True)
+    s = factory.strategy_singleton_instance(GenericStrategy)
+    for size in [0, 1, rs.UNROLL_CUTOFF, rs.UNROLL_CUTOFF + 1, 10000]:
+        values = [W_Object()] * size
+        l = W_List(GenericStrategy, size, values)
+        expected = size <= rs.UNROLL_CUTOFF
+        assert rs.unroll_elements(s, l, 0, values) == expected
+        assert rs.unroll_conversion(s, l, l.strategy) == expected
+        assert rs.unroll_objects(factory, values) == expected
+
+# === Map strategies
+
+class W_Map(W_AbstractObject):
+    rs.make_accessors()
+    def __init__(self):
+        self.strategy = None
+        map_factory.set_initial_strategy(self, EmptyMapStrategy, 0)
+    def lookup(self, w_key, w_default=None):
+        return self.strategy.lookup(self, w_key, w_default)
+    def put(self, w_key, w_value):
+        self.strategy.put(self, w_key, w_value)
+    def remove(self, w_key):
+        self.strategy.remove(self, w_key)
+    def size(self):
+        return self.strategy.size(self)
+    def items(self):
+        return self.strategy.items(self)
+
+class AbstractMapStrategy(object):
+    __metaclass__ = rs.StrategyMetaclass
+    import_from_mixin(rs.AbstractMapStrategy)
+    def __init__(self, factory, w_self=None, size=0):
+        self.factory = factory
+    def strategy_factory(self):
+        return self.factory
+
+class EmptyMapStrategy(AbstractMapStrategy):
+    import_from_mixin(rs.EmptyMapStrategy)
+
+class GenericMapStrategy(AbstractMapStrategy):
+    import_from_mixin(rs.GenericMapStrategy)
+
+class IntegerKeyedMapStrategy(AbstractMapStrategy):
+    import_from_mixin(rs.SingleTypeKeyMapStrategy)
+    contained_key_type = W_Integer
+    def wrap_key(self, key): return W_Integer(key)
+    def unwrap_key(self, w_key): return w_key.value
+
+class IntegerMapStrategy(AbstractMapStrategy):
+    import_from_mixin(rs.SingleTypeMapStrategy)
+    contained_key_type = W_Integer
+    contained_value_type = W_Integer
+    def wrap_key(self, key): return W_Integer(key)
+    def unwrap_key(self, w_key): return w_key.value
+    def wrap_value(self, value): return W_Integer(value)
+    def unwrap_value(self, w_value): return w_value.value
+
+class MapFactory(rs.StrategyFactory):
+    def __init__(self, root_class):
+        self.decorate_strategies({
+            EmptyMapStrategy: [IntegerMapStrategy, IntegerKeyedMapStrategy, GenericMapStrategy],
+            IntegerMapStrategy: [IntegerKeyedMapStrategy, GenericMapStrategy],
+            IntegerKeyedMapStrategy: [GenericMapStrategy],
+            GenericMapStrategy: [],
+        })
+        rs.StrategyFactory.__init__(self, root_class)
+    def instantiate_strategy(self, strategy_type, w_self=None, size=0):
+        return strategy_type(self, w_self, size)
+
+map_factory = MapFactory(AbstractMapStrategy)
+
+def test_map_empty():
+    m = W_Map()
+    assert isinstance(m.strategy, EmptyMapStrategy)
+    assert m.size() == 0
+    assert m.lookup(W_Integer(1)) is None
+    assert m.lookup(W_Integer(1), w_nil) is w_nil
+    py.test.raises(KeyError, m.remove, W_Integer(1))
+    assert m.items() == []
+
+def test_map_Integer():
+    m = W_Map()
+    m.put(W_Integer(1), W_Integer(10))
+    m.put(W_Integer(2), W_Integer(20))
+    assert isinstance(m.strategy, IntegerMapStrategy)
+    assert m.strategy.get_storage(m) == {1: 10, 2: 20}
+    assert m.lookup(W_Integer(1)) == W_Integer(10)
+    assert m.lookup(W_Object()) is None
+    m.remove(W_Integer(1))
+    assert m.size() == 1
+    py.test.raises(KeyError, m.remove, W_Integer(1))
+    py.test.raises(KeyError, m.remove, W_Object())
+
+def test_map_transitions():
+    m = W_Map()
+    o = W_Object()
+    m.put(W_Integer(1), W_Integer(10))
+    m.put(W_Integer(2), o)
+    assert isinstance(m.strategy, IntegerKeyedMapStrategy)
+    assert m.lookup(W_Integer(1)) == W_Integer(10)
+    assert m.lookup(W_Integer(2)) is o
+    key = W_Object()
+    m.put(key, w_nil)
+    assert isinstance(m.strategy, GenericMapStrategy)
+    assert m.size() == 3
+    assert m.lookup(key) is w_nil
+    assert m.lookup(W_Object()) is None
+    assert m.lookup(W_Integer(1)) == W_Integer(10)
+    assert m.lookup(W_Integer(2)) is o
+
+def test_map_Generic_integer_keys_by_value():
+    m = W_Map()
+    m.put(W_Integer(1), W_Integer(10))
+    m.put(W_Object(), w_nil)
+    assert isinstance(m.strategy, GenericMapStrategy)
+    assert m.lookup(W_Integer(1)) == W_Integer(10)
+    m.put(W_Integer(1), W_Integer(11))
+    assert m.size() == 2
+    assert m.lookup(W_Integer(1)) == W_Integer(11)
+    m.put(W_Integer(2), W_Integer(20))
+    assert m.size() == 3
+    m.remove(W_Integer(2))
+    assert m.lookup(W_Integer(2)) is None
+    assert m.lookup(W_Object()) is None
+
+def test_map_unboxed_key_strategies():
+    classes = [ s.__class__ for s in map_factory.unboxed_key_strategies ]
+    assert classes == [IntegerMapStrategy, IntegerKeyedMapStrategy]
+
+def test_map_empty_to_Generic():
+    m = W_Map()
+    key = W_Object()
+    m.put(key, w_nil)
+    assert isinstance(m.strategy, GenericMapStrategy)
+    assert m.items() == [(key, w_nil)]
+    m.remove(key)
+    assert m.size() == 0
@@ -0,0 +1,207 @@
+
+import os
+import rstrategies_logparser as parser
+from rstrategies_logger import TextSink, BinarySink, format_entry
+
+# === Log entries as written by the logger:
+# cause, old strategy, new strategy, typename, slots, objects, element typenames, histogram
+
+ENTRIES = [
+    ("Created", "", "IntegerStrategy", "W_List", 50, 10, [], [0, 0, 4, 6]),
+    ("Switched", "IntegerStrategy", "GenericStrategy", "W_List", 3, 1, ["W_Integer", "W_Object"], [0, 0, 1]),
+    ("Created", "", "EmptyStrategy", "W_List at site1", 0, 2, [], [2]),
+    ("Switched", "EmptyStrategy", "IntegerStrategy", "W_Array", 4, 2, ["W_Integer"], [0, 1, 1]),
+    ("Switched", "EmptyStrategy", "GenericStrategy", "", 7, 1, [], []),
+]
+
+COMMENTS = ["slot-bytes (IntegerStrategy) 8", "slot-bytes (GenericStrategy) 8"]
+
+def teardown():
+    # The names of parsed prefixes depend on the flags.
+    parser.prefix_cache.clear()
+
+def write_log(filename, entries, sink_class=TextSink, comments=COMMENTS):
+    fd = os.open(str(filename), os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    sink = sink_class(fd)
+    for comment in comments:
+        sink.write_comment(comment)
+    for entry in entries:
+        sink.write_entry(*entry)
+    sink.flush()
+    os.close(fd)
+    return str(filename)
+
+def flags(*args):
+    result = parser.default_flags()
+    args = iter(args)
+    for arg in args:
+        assert result.handle(arg, args)
+    return result
+
+def entry_fields(entry):
+    return (entry.operation, entry.old_storage, entry.new_storage, entry.classname, entry.size, entry.objects,
+            sorted(entry.classnames), entry.is_storage_source, sorted(entry.histogram.items()))
+
+def parse_all(logfile, flags):
+    entries = []
+    comments = []
+    parser.parse(logfile, flags, lambda entry: entries.append(entry_fields(entry)), comments.append)
+    return entries, comments
+
+def graph_summary(graph):
+    return sorted((key, is_storage_source, sorted((classname, objects, slots, sorted(element_classnames), sorted(histogram.items()))
+                        for classname, objects, slots, element_classnames, histogram in classes))
+                for key, is_storage_source, classes in parser.graph_edges(graph))
+
+# === Test parsing lines
+
+def test_parse_line_fast_like_regex():
+    lines = [ format_entry(*entry) for entry in ENTRIES ] + [
+        "Created (EmptyStrategy) size 0",
+        "Created (EmptyStrategy) of W_List size 12",
+        "Switched (EmptyStrategy -> IntegerStrategy) of W_List at site2 size 4 histogram 1:1,2:1 elements: W_Integer",
+        "Switched (EmptyStrategy -> IntegerStrategy) size 4 elements: W_Integer W_Object",
+    ]
+    for sites in [False, True]:
+        parser.prefix_cache.clear()
+        line_flags = flags("-l") if sites else flags()
+        for line in lines:
+            fast = parser.parse_line_fast(line, line_flags)
+            regex = parser.parse_line_regex(line, line_flags)
+            assert fast is not None and regex is not None
+            assert entry_fields(fast) == entry_fields(regex)
+            # Cached prefixes are resolved the same way.
+            assert entry_fields(parser.parse_line_fast(line, line_flags)) == entry_fields(regex)
+    parser.prefix_cache.clear()
+    assert parser.parse_line_fast(lines[2], flags()).classname == "W_List"
+
+def test_parse_line_fast_unknown_format():
+    for line in ["", "garbage", "Created EmptyStrategy size 0", "Created (EmptyStrategy) size x",
+                "Created (EmptyStrategy) size 0 objects", "Created (EmptyStrategy) size 0 unknown 1",
+                "Switched (EmptyStrategy IntegerStrategy) size 0"]:
+        assert parser.parse_line_fast(line, flags()) is None
+        assert parser.parse_line(line, flags()) is None
+
+# === Test reading logs
+
+def test_text_binary_round_trip(tmpdir):
+    text_log = write_log(tmpdir.join("text.log"), ENTRIES)
+    binary_log = write_log(tmpdir.join("binary.log"), ENTRIES, BinarySink)
+    text_entries, text_comments = parse_all(text_log, flags())
+    binary_entries, binary_comments = parse_all(binary_log, flags())
+    assert len(text_entries) == len(ENTRIES)
+    assert text_entries == binary_entries
+    assert text_comments == binary_comments == COMMENTS
+    assert not parser.can_shard(binary_log)
+
+def test_shard_boundaries_split_lines(tmpdir):
+    logfile = write_log(tmpdir.join("sharded.log"), ENTRIES * 8)
+    with open(logfile, 'rb') as file:
+        data = file.read()
+    size = len(data)
+    serial_entries, serial_comments = parse_all(logfile, flags())
+    split_lines = 0
+    for shards in range(1, 60):
+        split_lines += len([ i for i in range(1, shards) if data[size * i // shards - 1] != "\n" ])
+        boundaries = parser.shard_boundaries(logfile, shards)
+        assert 0 < len(boundaries) <= shards
+        assert boundaries[0][0] == 0 and boundaries[-1][1] == size
+        entries = []
+        comments = []
+        for (start, end), (next_start, _) in zip(boundaries, boundaries[1:] + [(size, size)]):
+            assert start < end == next_start
+            assert start == 0 or data[start - 1] == "\n"
+            with open(logfile, 'rb') as file:
+                for entry in parser.parse_text(parser.FileRange(file, start, end), "", flags()):
+                    if isinstance(entry, str):
+                        comments.append(entry)
+                    else:
+                        entries.append(entry_fields(entry))
+        assert entries == serial_entries
+        assert comments == serial_comments
+    # The byte offsets of most shards fall into the middle of a line.
+    assert split_lines > 0
+
+def test_sharded_graph(tmpdir):
+    logfile = write_log(tmpdir.join("sharded.log"), ENTRIES * 8)
+    serial = graph_summary(parser.make_graph(logfile, flags("-C")))
+    graph = parser.StorageGraph()
+    comments = []
+    for start, end in parser.shard_boundaries(logfile, 3):
+        edges, shard_comments = parser.parse_shard((logfile, start, end, flags("-C")))
+        graph.merge_edges(edges)
+        comments += shard_comments
+    assert graph_summary(graph) == serial
+    assert comments == COMMENTS
+    assert parser.can_shard(logfile)
+    assert graph_summary(parser.make_graph(logfile, flags("-C", "-j", "3"))) == serial
+
+# === Test the graph cache
+
+def test_cache_reused(tmpdir, monkeypatch):
+    logfile = write_log(tmpdir.join("cached.log"), ENTRIES)
+    expected = graph_summary(parser.make_graph(logfile, flags()))
+    assert os.path.isfile(parser.cache_file(logfile))
+    def parse(*args):
+        assert False, "cached log parsed again"
+    monkeypatch.setattr(parser, "parse", parse)
+    comments = []
+    assert graph_summary(parser.make_graph(logfile, flags(), comments.append)) == expected
+    assert comments == COMMENTS
+    # Other settings change the parsed names.
+    assert parser.load_cache(logfile, parser.cache_key(logfile, flags("-l")), flags()) is None
+    assert parser.cache_key(logfile, flags("-C")) is None
+
+def test_cache_stale(tmpdir):
+    logfile = write_log(tmpdir.join("cached.log"), ENTRIES[:2])
+    parser.make_graph(logfile, flags())
+    # The log grows.
+    write_log(logfile, ENTRIES)
+    expected = graph_summary(parser.make_graph(logfile, flags("-C")))
+    assert graph_summary(parser.make_graph(logfile, flags())) == expected
+    # The log changes without changing its size.
+    changed_entries = [ENTRIES[0][:4] + (51,) + ENTRIES[0][5:]] + ENTRIES[1:]
+    write_log(logfile, changed_entries)
+    mtime = os.stat(logfile).st_mtime + 10
+    os.utime(logfile, (mtime, mtime))
+    changed = graph_summary(parser.make_graph(logfile, flags()))
+    assert changed != expected
+    assert changed == graph_summary(parser.make_graph(logfile, flags("-C")))
+
+# === Test collapsing nodes
+
+def test_collapse_nonstorage_nodes(tmpdir, monkeypatch):
+    # No storage nodes are configured, so only the artificial Created node is kept (without -a).
+    monkeypatch.setattr(parser, "STORAGE_NODES", [])
+    logfile = write_log(tmpdir.join("unconfigured.log"), ENTRIES)
+    graph = parser.make_graph(logfile, flags("-C", "-D"))
+    assert len(graph.nodes) == 4
+    graph.collapse_nonstorage_nodes("Other")
+    graph.assert_sanity()
+    assert sorted(graph.nodes.keys()) == ["Created", "Other"]
+    created = graph.edges[("Created", "Created", "Other")].total()
+    assert (created.objects, created.slots) == (12, 50)
+    # Switches between collapsed nodes become a single edge from the new node to itself.
+    switched = graph.edges[("Switched", "Other", "Other")].total()
+    assert (switched.objects, switched.slots) == (4, 14)
+    assert len(graph.edges) == 2
+
+def test_collapse_some_storage_nodes(tmpdir, monkeypatch):
+    monkeypatch.setattr(parser, "STORAGE_NODES", ["GenericStrategy"])
+    logfile = write_log(tmpdir.join("configured.log"), ENTRIES)
+    graph = parser.make_graph(logfile, flags("-C", "-D"))
+    graph.collapse_nonstorage_nodes("Other")
+    graph.assert_sanity()
+    assert sorted(graph.nodes.keys()) == ["Created", "GenericStrategy", "Other"]
+    switched = graph.edges[("Switched", "Other", "GenericStrategy")].total()
+    assert (switched.objects, switched.slots) == (2, 10)
+    switched = graph.edges[("Switched", "Other", "Other")].total()
+    assert (switched.objects, switched.slots) == (2, 4)
+
+def test_summarize_without_allstorage(tmpdir, monkeypatch):
+    monkeypatch.setattr(parser, "STORAGE_NODES", [])
+    logfile = write_log(tmpdir.join("unconfigured.log"), ENTRIES)
+    output = parser.captured_output(parser.command_summarize, logfile, flags("-C"))
+    nodes = [ line for line in output.split("\n") if line.endswith(":") and not line.startswith("\t") ]
+    assert len(nodes) == 2 and "Created:" in nodes
+    assert "\tSwitched: 14 slots in 4 objects" in output